@@ -0,0 +1,12 @@
+import re
+from configparser import ConfigParser
+
+ADDR_TEMPLATE = "%s, %s, %s"
+DEST = ["The University of Chicago"]
+
+config_file = ConfigParser()
+config_file.read("config.ini")
+
+
+def normalize_address(addr):
+    return re.sub("\\s*,\\s*", ", ", " ".join(addr.lower().split()))
@@ -1,93 +1,277 @@
 import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import googlemaps
 import pandas as pd
 
+import address
+
 API_KEY = "KEY"
-ADDR_TEMPLATE = "%s, %s, %s"
-DEST = ["The University of Chicago"]
+TRAVEL_MODES = ["walking", "transit"]
+# the distance matrix api takes at most 25 origins per request
+MAX_ORIGINS = 25
+
+config_file = address.config_file
+BASE_URL = config_file.get("AUGMENT", "BASE_URL")
+CONCURRENCY = config_file.getint("AUGMENT", "CONCURRENCY")
+# requests per second across all threads
+RATE = config_file.getfloat("AUGMENT", "RATE")
+RETRIES = config_file.getint("AUGMENT", "RETRIES")
+BACKOFF = config_file.getfloat("AUGMENT", "BACKOFF")
+# the client's own retries are cut short, failed requests are retried here with jitter
+CLIENT_RETRY_TIMEOUT = 1
+CACHE_PATH = config_file.get("AUGMENT", "CACHE")
+CACHE_TTL = config_file.getfloat("AUGMENT", "CACHE_TTL_DAYS") * 24 * 60 * 60
+REQUEST_ERRORS = (googlemaps.exceptions.ApiError, googlemaps.exceptions.HTTPError,
+                  googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError)
+
+
+def create_client():
+    return googlemaps.Client(key=API_KEY, base_url=BASE_URL, retry_timeout=CLIENT_RETRY_TIMEOUT,
+                             retry_over_query_limit=False, queries_per_second=int(RATE) * 2 + 1)
+
+
+def token_bucket(rate, capacity):
+    lock = threading.Lock()
+    state = {"tokens": capacity, "time": time.monotonic()}
+
+    def acquire():
+        while True:
+            with lock:
+                now = time.monotonic()
+                state["tokens"] = min(capacity, state["tokens"] + (now - state["time"]) * rate)
+                state["time"] = now
+                if state["tokens"] >= 1:
+                    state["tokens"] = state["tokens"] - 1
+                    return
+                wait = (1 - state["tokens"]) / rate
+            time.sleep(wait)
+
+    return acquire
+
+
+def open_cache(path, ttl):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("CREATE TABLE IF NOT EXISTS lookups (key TEXT PRIMARY KEY, value TEXT, fetched REAL)")
+    connection.execute("DELETE FROM lookups WHERE fetched < ?", (time.time() - ttl,))
+    connection.commit()
+    lock = threading.Lock()
+    stats = {"hits": 0, "misses": 0}
+
+    def lookup(key):
+        with lock:
+            row = connection.execute("SELECT value, fetched FROM lookups WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < time.time() - ttl:
+                stats["misses"] = stats["misses"] + 1
+                return None
+            stats["hits"] = stats["hits"] + 1
+            return json.loads(row[0])
+
+    def store(key, value):
+        with lock:
+            connection.execute("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+            connection.commit()
+
+    return lookup, store, stats
+
+
+def geo_key(addr):
+    return json.dumps(["geo", address.normalize_address(addr)])
+
+
+def transit_key(addr, mode, departure):
+    return json.dumps(["transit", address.normalize_address(addr), mode, address.DEST, departure.isoformat()])
+
+
+def print_hit_rate(name):
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    hit_rate = cache_stats["hits"] / max(lookups, 1) * 100
+    print("%s cache: %d/%d hits (%.0f%%)" % (name, cache_stats["hits"], lookups, hit_rate))
+    cache_stats["hits"] = 0
+    cache_stats["misses"] = 0
+
+
+def backoff(attempt):
+    time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def run_concurrently(function, items):
+    results = []
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        for result in pool.map(function, items):
+            if result is None:
+                continue
+            results.append(result)
+            if len(results) % 500 == 0:
+                print("%d/%d" % (len(results), len(items)))
+    return results
+
+
+def geocode_address(addr):
+    cached = cache_lookup(geo_key(addr))
+    if cached is not None:
+        return addr, cached[0], cached[1]
+    for attempt in range(RETRIES):
+        if attempt > 0:
+            backoff(attempt - 1)
+        try:
+            rate_limit()
+            geocode = gmaps.geocode(addr)
+        except REQUEST_ERRORS as error:
+            print("Failed to fetch geo: %s (%r)" % (addr, error))
+            continue
+        try:
+            geocode_elt = geocode[0]["geometry"]["location"]
+            lat = geocode_elt["lat"]
+            lng = geocode_elt["lng"]
+        except (IndexError, KeyError):
+            print("Failed to find lat, lng for: " + addr)
+            print(geocode)
+            continue
+        cache_store(geo_key(addr), [lat, lng])
+        return addr, lat, lng
+    print("All %d retries failed for: %s" % (RETRIES, addr))
+    return None
 
 
 def fetch_geo(addresses):
     data_dict = {"address": [], "lat": [], "lng": []}
-    for addr in set(addresses):
-        retry = 0
-        while retry < 3:
-            try:
-                geocode = gmaps.geocode(addr)
-            except:
-                print("Failed to fetch geo: " + addr)
-                retry = retry + 1
-                continue
-            try:
-                geocode_elt = geocode[0]["geometry"]["location"]
-                lat = geocode_elt["lat"]
-                lng = geocode_elt["lng"]
-            except (IndexError, KeyError):
-                print("Failed to find lat, lng for: " + addr)
-                print(geocode)
-                retry = retry + 1
-                continue
-            data_dict["address"].append(addr)
-            data_dict["lat"].append(lat)
-            data_dict["lng"].append(lng)
-            if len(data_dict["address"]) % 500 == 0:
-                print("%d/%d" % (len(data_dict["address"]), len(set(addresses))))
-            break
-        if retry == 3:
-            print("All 3 retries failed for: " + addr)
+    for addr, lat, lng in run_concurrently(geocode_address, list(set(addresses))):
+        data_dict["address"].append(addr)
+        data_dict["lat"].append(lat)
+        data_dict["lng"].append(lng)
+    print_hit_rate("Geo")
     return data_dict
 
 
+def fetch_matrix_block(mode, block, departure):
+    try:
+        rate_limit()
+        matrix = gmaps.distance_matrix(block, address.DEST, mode=mode, departure_time=departure)
+    except REQUEST_ERRORS as error:
+        print("Failed to fetch transit for %d addresses (%r)" % (len(block), error))
+        return None
+    elements = []
+    for index in range(len(block)):
+        try:
+            elements.append(matrix["rows"][index]["elements"][0])
+        except (IndexError, KeyError):
+            elements.append({})
+    return elements
+
+
+def fetch_matrix_elements(addresses, elements, departure):
+    blocks = []
+    for mode in TRAVEL_MODES:
+        missing = [addr for addr in addresses if mode not in elements[addr]]
+        for start in range(0, len(missing), MAX_ORIGINS):
+            blocks.append((mode, missing[start:start + MAX_ORIGINS]))
+
+    def fetch(mode_block):
+        mode, block = mode_block
+        return mode, block, fetch_matrix_block(mode, block, departure)
+
+    fetched = {}
+    failed = set()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        for mode, block, block_elements in pool.map(fetch, blocks):
+            if block_elements is None:
+                failed.update(block)
+                continue
+            for addr, element in zip(block, block_elements):
+                fetched.setdefault(addr, {})[mode] = element
+    return fetched, failed
+
+
+def parse_transit(addr, walk_elt, transit_elt):
+    try:
+        distance = walk_elt["distance"]["value"]
+        walk_time = walk_elt["duration"]["value"] / 60
+    except KeyError:
+        print("Failed to get transportation info: " + addr)
+        return None
+    try:
+        transit_time = transit_elt["duration"]["value"] / 60
+    except KeyError:
+        print("Failed to find transit for: " + addr)
+        return None
+    return distance, walk_time, transit_time
+
+
 def fetch_transit(addresses):
     data_dict = {"address": [], "distance": [], "walk.time": [], "transit.time": []}
-    time = datetime.now()
-    time = time.replace(month=6, day=20, hour=9, minute=30)
-    for addr in set(addresses):
-        retry = 0
-        while retry < 3:
-            try:
-                matrix_walk = gmaps.distance_matrix(addr, DEST, mode="walking", departure_time=time)
-                matrix_transit = gmaps.distance_matrix(addr, DEST, mode="transit", departure_time=time)
-            except:
-                print("Failed to fetch transit: " + addr)
-                retry = retry + 1
-                continue
-            try:
-                walk_elt = matrix_walk["rows"][0]["elements"][0]
-                transit_elt = matrix_transit["rows"][0]["elements"][0]
-                distance = walk_elt["distance"]["value"]
-                walk_time = walk_elt["duration"]["value"] / 60
-            except (IndexError, KeyError):
-                print("Failed to get transportation info: " + addr)
-                retry = retry + 1
+    departure = datetime.now()
+    # seconds are dropped so the departure, and the cache key, stay the same through the day
+    departure = departure.replace(month=6, day=20, hour=9, minute=30, second=0, microsecond=0)
+    unique_addresses = list(set(addresses))
+    elements = {}
+    for addr in unique_addresses:
+        elements[addr] = {}
+        for mode in TRAVEL_MODES:
+            cached = cache_lookup(transit_key(addr, mode, departure))
+            if cached is not None:
+                elements[addr][mode] = cached
+
+    results = {}
+    pending = unique_addresses
+    for attempt in range(RETRIES):
+        if attempt > 0:
+            backoff(attempt - 1)
+        fetched, failed = fetch_matrix_elements(pending, elements, departure)
+        retry = []
+        for addr in pending:
+            if addr in failed:
+                retry.append(addr)
                 continue
-            try:
-                transit_time = transit_elt["duration"]["value"] / 60
-            except KeyError:
-                print("Failed to find transit for: " + addr)
-                retry = retry + 1
+            addr_elements = dict(elements[addr], **fetched.get(addr, {}))
+            transit = parse_transit(addr, addr_elements["walking"], addr_elements["transit"])
+            if transit is None:
+                retry.append(addr)
                 continue
-            data_dict["address"].append(addr)
-            data_dict["distance"].append(distance)
-            data_dict["walk.time"].append(walk_time)
-            data_dict["transit.time"].append(transit_time)
-            if len(data_dict["distance"]) % 500 == 0:
-                print("%d/%d" % (len(data_dict["distance"]), len(set(addresses))))
+            for mode in fetched.get(addr, {}):
+                cache_store(transit_key(addr, mode, departure), fetched[addr][mode])
+            results[addr] = transit
+        pending = retry
+        if len(pending) == 0:
             break
-        if retry == 3:
-            print("All 3 retries failed for: " + addr)
+    for addr in pending:
+        print("All %d retries failed for: %s" % (RETRIES, addr))
+
+    for addr in unique_addresses:
+        if addr not in results:
+            continue
+        distance, walk_time, transit_time = results[addr]
+        data_dict["address"].append(addr)
+        data_dict["distance"].append(distance)
+        data_dict["walk.time"].append(walk_time)
+        data_dict["transit.time"].append(transit_time)
+    print_hit_rate("Transit")
     return data_dict
 
 
+gmaps = None
+rate_limit = token_bucket(RATE, CONCURRENCY)
+cache_lookup, cache_store, cache_stats = open_cache(":memory:", CACHE_TTL)
+
 if __name__ == "__main__":
-    gmaps = googlemaps.Client(key=API_KEY)
+    if "--offline" in sys.argv:
+        import offline
+        fetch_transit = offline.fetch_transit
+        fetch_geo = offline.fetch_geo
+    else:
+        gmaps = create_client()
+        cache_lookup, cache_store, cache_stats = open_cache(CACHE_PATH, CACHE_TTL)
     with open("compile.json", "r") as fp:
         apartments = json.load(fp)
     addresses = []
     for p in apartments:
-        addresses.append(ADDR_TEMPLATE % (p["address"], p["city"], p["state"]))
+        addresses.append(address.ADDR_TEMPLATE % (p["address"], p["city"], p["state"]))
 
     transit_dict = fetch_transit(addresses)
     transit_df = pd.DataFrame(transit_dict)
@@ -0,0 +1,14 @@
+def pop_flag(args, name):
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+
+def pop_option(args, name, default=None):
+    if name not in args:
+        return default
+    index = args.index(name)
+    value = args[index + 1]
+    del args[index:index + 2]
+    return value
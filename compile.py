@@ -1,17 +1,38 @@
 import json
 import math
+import multiprocessing as mp
+import os
 import re
 import statistics
 import sys
+import traceback
 from functools import partial
 
+import numpy as np
 import pandas as pd
 
+import cli
 import extract
 
 AMENITIES_LIMIT = 0
 FEATURES_LIMIT = 0
 UNK_LABEL = "Unknown"
+PIPELINE_CHUNK_SIZE = 8
+# apartments converted to rows and written out at a time in streaming mode
+STREAM_BATCH_SIZE = 500
+# the amenity, feature, school and college indicator columns in sparse mode
+INDICATORS_MATRIX = "compile_indicators.npz"
+INDICATORS_VOCABULARY = "compile_indicators.json"
+KEEP_EXTRACT = False
+JOB_SHARDS_PER_WORKER = 4
+JOB_STATE = {}
+VALUE_KINDS = {bool: "b", int: "i", float: "f", str: "O"}
+KIND_DTYPES = {"b": bool, "i": np.int64, "f": np.float64, "O": object}
+# parsed values of the corpus' number strings, primed in one batch when the whole corpus is in memory
+NUMBER_CACHE = {}
+# ascii only so pyarrow and python regex agree, non-ascii characters are kept to reject the token
+NUMBER_STRIP_PATTERN = "[^0-9*.?+\x80-\U0010ffff]"
+NUMBER_TOKEN_PATTERN = "[+]?([0-9]+\\.?[0-9]*|\\.[0-9]+)"
 
 
 def copy_or_unknown(in_dict, out_dict, in_key, out_key):
@@ -22,7 +43,10 @@ def copy_or_unknown(in_dict, out_dict, in_key, out_key):
 
 
 def sorted_freq_list(items):
-    items_freq = freq_table(items)
+    return sorted_freq_table(freq_table(items))
+
+
+def sorted_freq_table(items_freq):
     sorted_items = []
     for key, freq in items_freq.items():
         sorted_items.append((key, freq))
@@ -48,14 +72,89 @@ def parse_number_range(string):
     return statistics.mean(numbers)
 
 
+def vector_number_ranges(strings):
+    series = pd.Series(strings, dtype=object)
+    row_count = len(series)
+    if row_count == 0:
+        return np.zeros(0), np.zeros(0, dtype=bool)
+    series.index = range(row_count)
+    en_dash = series.str.contains("–", regex=False)
+    parts = series.str.split("-", regex=False).where(~en_dash, series.str.split("–", regex=False)).explode()
+    tokens = parts.str.replace(NUMBER_STRIP_PATTERN, "", regex=True)
+    present = tokens.str.len() > 0
+    valid = tokens.str.fullmatch(NUMBER_TOKEN_PATTERN).astype(bool)
+    # tokens float() would reject and ranges of more than two numbers are left to parse_number_range
+    rejected = (present & ~valid).groupby(level=0).any().to_numpy()
+    numbers = tokens[present & valid].astype(float).groupby(level=0)
+    rows = range(row_count)
+    counts = numbers.count().reindex(rows, fill_value=0).to_numpy()
+    first = numbers.first().reindex(rows).to_numpy(dtype=float)
+    last = numbers.last().reindex(rows).to_numpy(dtype=float)
+    # the mean of two floats is their rounded sum halved, as statistics.mean gives
+    values = np.where(counts == 1, first, (first + last) / 2)
+    values[counts == 0] = float("nan")
+    return values, ~rejected & (counts <= 2)
+
+
+def parse_number_ranges(strings):
+    values, handled = vector_number_ranges(strings)
+    for index in np.flatnonzero(~handled):
+        values[index] = parse_number_range(strings[index])
+    return values
+
+
+def prime_number_cache(strings):
+    strings = list(set(strings) - NUMBER_CACHE.keys())
+    values, handled = vector_number_ranges(strings)
+    for string, value, ok in zip(strings, values.tolist(), handled.tolist()):
+        if ok:
+            NUMBER_CACHE[string] = value
+
+
+def number_range(string):
+    # strings missed by priming are parsed each time, so the streamed paths do not grow the cache
+    if string in NUMBER_CACHE:
+        return NUMBER_CACHE[string]
+    return parse_number_range(string)
+
+
+def collect_number_strings(raw, strings):
+    if "fees" in raw:
+        for policies in raw["fees"].values():
+            for policy in policies:
+                for segment in policy.get("segments", []):
+                    if "content" in segment:
+                        strings.append(segment["content"])
+    if "education" in raw and "colleges" in raw["education"]:
+        for college in raw["education"]["colleges"]:
+            strings.append(college[-1])
+    for transportation in raw.get("transportation", []):
+        for available in transportation["available"]:
+            strings.append(available[-1])
+    for score in ["transit_score", "bike_score", "walk_score", "sound_score"]:
+        if score in raw.get("environment", {}):
+            strings.append(raw["environment"][score])
+    for model in raw.get("models", []):
+        strings.extend(model["details"][:3])
+        if "rent" in model:
+            strings.append(model["rent"])
+        for unit in model.get("units", []):
+            strings.append(unit["rent"])
+            strings.append(unit["sqft"])
+
+
 def freq_table(list_data):
     table = {}
+    add_freq(table, list_data)
+    return table
+
+
+def add_freq(table, list_data):
     for item in list_data:
         if item not in table:
             table[item] = 1
         else:
             table[item] = table[item] + 1
-    return table
 
 
 def copy_header_address(raw, output):
@@ -88,7 +187,7 @@ def copy_desc_information(raw, output):
 
 
 def parse_fee_with_default(fee_str, default=0):
-    fee = parse_number_range(fee_str)
+    fee = number_range(fee_str)
     if math.isnan(fee):
         return default
     return fee
@@ -213,7 +312,7 @@ def compile_education_info(raw, output):
     if "colleges" in education:
         for college in education["colleges"]:
             name = college[0]
-            distance = parse_number_range(college[-1])
+            distance = number_range(college[-1])
             college_infos.append({"name": name, "distance": distance})
     school_infos = []
     if "public_schools" in education:
@@ -230,7 +329,7 @@ def extract_transportation_section(transportation_list):
     results = []
     for transportation in transportation_list:
         name = transportation[0]
-        distance = parse_number_range(transportation[-1])
+        distance = number_range(transportation[-1])
         results.append({"name": name, "distance": distance})
     return results
 
@@ -260,13 +359,13 @@ def copy_environment(raw, output):
         return
     environment = raw["environment"]
     if "transit_score" in environment:
-        output["transit_score"] = parse_number_range(environment["transit_score"])
+        output["transit_score"] = number_range(environment["transit_score"])
     if "bike_score" in environment:
-        output["bike_score"] = parse_number_range(environment["bike_score"])
+        output["bike_score"] = number_range(environment["bike_score"])
     if "walk_score" in environment:
-        output["walk_score"] = parse_number_range(environment["walk_score"])
+        output["walk_score"] = number_range(environment["walk_score"])
     if "sound_score" in environment:
-        output["sound_score"] = parse_number_range(environment["sound_score"])
+        output["sound_score"] = number_range(environment["sound_score"])
     if "traffic_level" in environment:
         output["traffic_level"] = environment["traffic_level"]
     if "busi_level" in environment:
@@ -280,14 +379,14 @@ def find_model_median_area_rent(model):
         unit_rents = []
         unit_sqfts = []
         for unit in model["units"]:
-            unit_rents.append(parse_number_range(unit["rent"]))
-            unit_sqfts.append(parse_number_range(unit["sqft"]))
+            unit_rents.append(number_range(unit["rent"]))
+            unit_sqfts.append(number_range(unit["sqft"]))
         return statistics.median(unit_sqfts), statistics.median(unit_rents)
     else:
         rent = float("nan")
         if "rent" in model:
-            rent = parse_number_range(model["rent"])
-        sqft = parse_number_range(model["details"][2])
+            rent = number_range(model["rent"])
+        sqft = number_range(model["details"][2])
         return sqft, rent
 
 
@@ -296,8 +395,8 @@ def extract_model_setup(model, output):
     if model["details"][0] == "Studio":
         output["beds"] = 0
     else:
-        output["beds"] = parse_number_range(model["details"][0])
-    output["baths"] = parse_number_range(model["details"][1])
+        output["beds"] = number_range(model["details"][0])
+    output["baths"] = number_range(model["details"][1])
     if "features" in model:
         output["features"] = model["features"]
     sqft, rent = find_model_median_area_rent(model)
@@ -340,35 +439,106 @@ def compile_information(raw, output):
 
 
 def convert_to_csv(output_data, processors):
-    columns = {}
-    handlers = []
+    column_defaults, fillers = make_fillers(processors)
+    return convert_rows(output_data, column_defaults, fillers)
+
+
+def make_fillers(processors):
+    column_defaults = {}
+    fillers = []
     for processor in processors:
-        cols, handler = processor()
-        for col in cols:
-            columns[col] = []
-        handlers.append(handler)
+        defaults, filler = processor()
+        for col in defaults:
+            if col not in column_defaults:
+                column_defaults[col] = defaults[col]
+        fillers.append(filler)
+    return column_defaults, fillers
+
+
+def value_kind(value):
+    if type(value) in VALUE_KINDS:
+        return VALUE_KINDS[type(value)]
+    if isinstance(value, bool):
+        return "b"
+    if isinstance(value, int):
+        return "i"
+    if isinstance(value, float):
+        return "f"
+    return "O"
+
+
+def allocate_columns(column_defaults, row_count):
+    columns = {}
+    for col in column_defaults:
+        default = column_defaults[col]
+        kind = value_kind(default)
+        if kind == "b":
+            columns[col] = np.full(row_count, default, dtype=bool)
+        elif kind == "i":
+            columns[col] = np.full(row_count, default, dtype=np.int64)
+        elif kind == "f":
+            columns[col] = np.full(row_count, default, dtype=np.float64)
+        else:
+            columns[col] = np.full(row_count, default, dtype=object)
+    return columns
+
+
+def set_cell(columns, col, row, value):
+    column = columns[col]
+    column_kind = column.dtype.kind
+    if column_kind != "O":
+        kind = value_kind(value)
+        # mixed columns keep the python values, pandas infers their dtype as it did from lists
+        if column_kind != kind:
+            columns[col] = column = column.astype(object)
+    column[row] = value
+
+
+def convert_rows(output_data, column_defaults, fillers):
+    return finalize_columns(fill_columns(output_data, column_defaults, fillers))
+
+
+def fill_columns(output_data, column_defaults, fillers):
+    row_count = 0
+    for data in output_data:
+        if "models" in data:
+            row_count = row_count + len(data["models"])
+    columns = allocate_columns(column_defaults, row_count)
+    row = 0
     for data in output_data:
         if "models" not in data:
             continue
         for model in data["models"]:
-            for handler in handlers:
-                combined = handler(model, data)
-                for col in combined:
-                    columns[col].append(combined[col])
+            for filler in fillers:
+                filler(model, data, row, columns)
+            row = row + 1
+    return columns
+
+
+def finalize_columns(columns):
+    for col in columns:
+        if columns[col].dtype.kind == "O":
+            columns[col] = pd.Series(columns[col]).infer_objects()
+    return columns
+
+
+def concat_columns(blocks):
+    columns = {}
+    for col in blocks[0]:
+        arrays = [block[col] for block in blocks]
+        if len(set(array.dtype for array in arrays)) > 1:
+            arrays = [array.astype(object) for array in arrays]
+        columns[col] = np.concatenate(arrays)
     return columns
 
 
 def copy_apartment_processor(cols, default=None):
-    def copy_handler(model, data):
-        result = {}
+    def copy_filler(model, data, row, columns):
         for col in cols:
-            val = default
             if col in data:
-                val = data[col]
-            result[cols[col]] = val
-        return result
+                set_cell(columns, cols[col], row, data[col])
 
-    return set(cols.values()), copy_handler
+    return dict.fromkeys(cols.values(), default), copy_filler
 
 
 def escape_for_csv(string):
@@ -379,244 +549,525 @@ def escape_for_csv(string):
     return string
 
 
-def amenities_processor(compiled_data):
-    amenities = []
-    for data in compiled_data:
-        if "amenities" in data:
-            amenities.extend(data["amenities"])
-    sorted_amenities = sorted_freq_list(amenities)
+def amenities_processor(amenities_freq):
+    sorted_amenities = sorted_freq_table(amenities_freq)
     cols = {}
     for key, freq in sorted_amenities:
         if freq >= AMENITIES_LIMIT:
             cols[key] = "amenities." + escape_for_csv(key)
 
-    def handle_amenities(model, data):
-        result = {}
-        for target in cols.values():
-            result[target] = False
+    def amenities_terms(model, data):
+        result = []
         if "amenities" in data:
             for item in data["amenities"]:
                 if item in cols:
-                    result[cols[item]] = True
+                    result.append(cols[item])
         return result
 
-    return set(list(cols.values())), handle_amenities
+    return list(cols.values()), amenities_terms
+
+
+def dense_indicator_processor(indicator_processor):
+    cols, terms = indicator_processor()
+
+    def indicator_filler(model, data, row, columns):
+        for target in terms(model, data):
+            columns[target][row] = True
+
+    return dict.fromkeys(cols, False), indicator_filler
 
 
 def pet_processor():
-    cols = {"pet.allowed", "pet.rent", "pet.deposit", "pet.fee"}
+    defaults = {"pet.allowed": "unknown", "pet.rent": 0, "pet.deposit": 0, "pet.fee": 0}
 
-    def pet_handler(model, data):
-        result = {"pet.allowed": "unknown", "pet.rent": 0, "pet.deposit": 0, "pet.fee": 0}
+    def pet_filler(model, data, row, columns):
         if "pet" in data:
             pet = data["pet"]
             if "type" in pet:
-                result["pet.allowed"] = pet["type"]
+                set_cell(columns, "pet.allowed", row, pet["type"])
             if "one_time_fee" in pet:
-                result["pet.fee"] = pet["one_time_fee"]
+                set_cell(columns, "pet.fee", row, pet["one_time_fee"])
             if "deposit" in pet:
-                result["pet.deposit"] = pet["deposit"]
+                set_cell(columns, "pet.deposit", row, pet["deposit"])
             if "rent" in pet:
-                result["pet.rent"] = pet["rent"]
-        return result
+                set_cell(columns, "pet.rent", row, pet["rent"])
 
-    return cols, pet_handler
+    return defaults, pet_filler
 
 
 def parking_processor():
-    cols = {"has.lot", "has.garage", "has.street", "has.covered", "lot.fee", "garage.fee", "street.fee", "covered.fee",
-            "lot.fee"}
-
-    def parking_handler(model, data):
-        result = {
-            "has.lot": False,
-            "has.garage": False,
-            "has.street": False,
-            "has.covered": False,
-            "lot.fee": 0,
-            "garage.fee": 0,
-            "street.fee": 0,
-            "covered.fee": 0
-        }
-
+    defaults = {
+        "has.lot": False,
+        "has.garage": False,
+        "has.street": False,
+        "has.covered": False,
+        "lot.fee": 0,
+        "garage.fee": 0,
+        "street.fee": 0,
+        "covered.fee": 0
+    }
+
+    def parking_filler(model, data, row, columns):
         if "parking" in data:
             parking = data["parking"]
             if "garage_fee" in parking:
-                result["has.garage"] = True
-                result["garage.fee"] = parking["garage_fee"]
+                set_cell(columns, "has.garage", row, True)
+                set_cell(columns, "garage.fee", row, parking["garage_fee"])
             if "lot_fee" in parking:
-                result["has.lot"] = True
-                result["lot.fee"] = parking["lot_fee"]
+                set_cell(columns, "has.lot", row, True)
+                set_cell(columns, "lot.fee", row, parking["lot_fee"])
             if "street_fee" in parking:
-                result["has.street"] = True
-                result["street.fee"] = parking["street_fee"]
+                set_cell(columns, "has.street", row, True)
+                set_cell(columns, "street.fee", row, parking["street_fee"])
             if "covered_fee" in parking:
-                result["has.covered"] = True
-                result["covered.fee"] = parking["covered_fee"]
-        return result
+                set_cell(columns, "has.covered", row, True)
+                set_cell(columns, "covered.fee", row, parking["covered_fee"])
 
-    return cols, parking_handler
+    return defaults, parking_filler
 
 
-def find_colleges_csv(compiled_data):
-    college_vector_map = {}
+def collect_vocabularies(compiled_data):
+    vocabularies = {"amenities": {}, "features": {}, "colleges": {}, "school_types": {}, "schools": {}}
     for data in compiled_data:
-        if "colleges" in data:
-            for college in data["colleges"]:
-                college_vector_map[college["name"]] = escape_for_csv(college["name"])
-    return college_vector_map
+        add_vocabulary(vocabularies, data)
+    return vocabularies
+
+
+def add_vocabulary(vocabularies, data):
+    if "amenities" in data:
+        add_freq(vocabularies["amenities"], data["amenities"])
+    if "models" in data:
+        for model in data["models"]:
+            if "features" in model:
+                add_freq(vocabularies["features"], model["features"])
+    if "colleges" in data:
+        for college in data["colleges"]:
+            vocabularies["colleges"][college["name"]] = escape_for_csv(college["name"])
+    if "schools" in data:
+        for school in data["schools"]:
+            vocabularies["school_types"][school["type"]] = escape_for_csv(school["type"])
+            vocabularies["schools"][school["name"]] = escape_for_csv(school["name"])
 
 
 def college_aggregate_processor(college_vector_map):
-    aggregate_cols = ["college.count"]
+    defaults = {"college.count": 0}
 
-    def college_handler(model, data):
-        result = {"college.count": 0}
+    def college_filler(model, data, row, columns):
         if "colleges" in data:
-            for college in data["colleges"]:
-                result["college.count"] += 1
-        return result
+            set_cell(columns, "college.count", row, len(data["colleges"]))
 
-    return aggregate_cols, college_handler
+    return defaults, college_filler
 
 
 def college_name_processor(college_vector_map):
 
-    def college_handler(model, data):
-        result = {}
-        for val in college_vector_map.values():
-            result[val] = False
+    def college_terms(model, data):
+        result = []
         if "colleges" in data:
             for college in data["colleges"]:
-                result[college_vector_map[college["name"]]] = True
+                result.append(college_vector_map[college["name"]])
         return result
 
-    return list(college_vector_map.values()), college_handler
-
-
-def find_schools_csv(compiled_data):
-    aggregate_cols = {}
-    school_vector_map = {}
-    for data in compiled_data:
-        if "schools" in data:
-            for school in data["schools"]:
-                aggregate_cols[school["type"]] = escape_for_csv(school["type"])
-                school_vector_map[school["name"]] = escape_for_csv(school["name"])
-    return aggregate_cols, school_vector_map
+    return list(college_vector_map.values()), college_terms
 
 
 def aggregate_school_processor(aggregate_cols):
 
-    def school_handler(model, data):
-        result = {}
-        for val in aggregate_cols.values():
-            result[val] = 0
-
+    def school_filler(model, data, row, columns):
         if "schools" in data:
+            counts = {}
             for school in data["schools"]:
-                result[aggregate_cols[school["type"]]] += 1
-        return result
-    return set(aggregate_cols.values()), school_handler
+                col = aggregate_cols[school["type"]]
+                counts[col] = counts.get(col, 0) + 1
+            for col in counts:
+                set_cell(columns, col, row, counts[col])
+    return dict.fromkeys(aggregate_cols.values(), 0), school_filler
 
 
 def school_name_processor(school_vector_map):
 
-    def school_handler(model, data):
-        result = {}
-        for val in school_vector_map.values():
-            result[val] = False
-
+    def school_terms(model, data):
+        result = []
         if "schools" in data:
             for school in data["schools"]:
-                result[school_vector_map[school["name"]]] = True
+                result.append(school_vector_map[school["name"]])
         return result
-    return set(school_vector_map.values()), school_handler
+    return list(school_vector_map.values()), school_terms
 
 
 def transportation_processor():
-    cols = {"transit.num", "rail.num", "air.num", "shopping.num", "rec.num", "base.num"}
-
-    def transportation_handler(model, data):
-        result = {
-            "transit.num": 0,
-            "rail.num": 0,
-            "air.num": 0,
-            "shopping.num": 0,
-            "rec.num": 0,
-            "base.num": 0
-        }
+    defaults = {
+        "transit.num": 0,
+        "rail.num": 0,
+        "air.num": 0,
+        "shopping.num": 0,
+        "rec.num": 0,
+        "base.num": 0
+    }
+
+    def transportation_filler(model, data, row, columns):
         if "nearby_transit" in data:
-            result["transit.num"] = len(data["nearby_transit"])
+            set_cell(columns, "transit.num", row, len(data["nearby_transit"]))
         if "nearby_rail" in data:
-            result["rail.num"] = len(data["nearby_rail"])
+            set_cell(columns, "rail.num", row, len(data["nearby_rail"]))
         if "nearby_air" in data:
-            result["air.num"] = len(data["nearby_air"])
+            set_cell(columns, "air.num", row, len(data["nearby_air"]))
         if "nearby_shopping" in data:
-            result["shopping.num"] = len(data["nearby_shopping"])
+            set_cell(columns, "shopping.num", row, len(data["nearby_shopping"]))
         if "nearby_rec" in data:
-            result["rec.num"] = len(data["nearby_rec"])
+            set_cell(columns, "rec.num", row, len(data["nearby_rec"]))
         if "nearby_bases" in data:
-            result["base.num"] = len(data["nearby_bases"])
-        return result
+            set_cell(columns, "base.num", row, len(data["nearby_bases"]))
 
-    return cols, transportation_handler
+    return defaults, transportation_filler
 
 
 def copy_model_processor(cols, default=None):
-    def copy_model_handler(model, data):
-        result = {}
+    def copy_model_filler(model, data, row, columns):
         for col in cols:
-            val = default
             if col in model:
-                val = model[col]
-            result[cols[col]] = val
-        return result
+                set_cell(columns, cols[col], row, model[col])
 
-    return set(cols.values()), copy_model_handler
+    return dict.fromkeys(cols.values(), default), copy_model_filler
 
 
-def features_processor(compiled_data):
-    features = []
-    for data in compiled_data:
-        if "models" in data:
-            for model in data["models"]:
-                if "features" in model:
-                    features.extend(model["features"])
-
-    sorted_features = sorted_freq_list(features)
+def features_processor(features_freq):
+    sorted_features = sorted_freq_table(features_freq)
     cols = {}
     for key, freq in sorted_features:
         if freq >= FEATURES_LIMIT:
             cols[key] = "features." + escape_for_csv(key)
 
-    def handle_features(model, data):
-        result = {}
-        for target in cols.values():
-            result[target] = False
+    def features_terms(model, data):
+        result = []
         if "features" in model:
             for item in model["features"]:
                 if item in cols:
-                    result[cols[item]] = True
+                    result.append(cols[item])
         return result
 
-    return set(list(cols.values())), handle_features
+    return list(cols.values()), features_terms
 
 
-if __name__ == "__main__":
-    extract_path = sys.argv[1]
-    input_data = extract.load_json_from(extract_path)
+def compile_extracted(input_data):
+    prime_input_numbers(input_data)
+    return compile_items(input_data.items())
 
-    result = []
+
+def prime_input_numbers(input_data):
+    strings = []
     for key in input_data:
+        collect_number_strings(input_data[key], strings)
+    prime_number_cache(strings)
+
+
+def compile_items(items):
+    result = []
+    for key, input_frame in items:
         print("Processing: " + key)
-        input_frame = input_data[key]
         output_frame = {}
         compile_information(input_frame, output_frame)
         if len(output_frame) > 0:
             result.append(output_frame)
+    return result
+
+
+def shard_ranges(count, jobs):
+    shard_count = max(1, min(count, jobs * JOB_SHARDS_PER_WORKER))
+    bounds = [count * shard // shard_count for shard in range(shard_count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def compile_shard(bounds):
+    start, end = bounds
+    return compile_items(JOB_STATE["items"][start:end])
+
+
+def fill_shard(bounds):
+    start, end = bounds
+    return fill_columns(JOB_STATE["records"][start:end], JOB_STATE["defaults"], JOB_STATE["fillers"])
+
+
+# the shard inputs and the filler closures reach the workers through fork instead of pickling
+def run_jobs(jobs, function, count, **state):
+    JOB_STATE.clear()
+    JOB_STATE.update(state)
+    with mp.get_context("fork").Pool(jobs) as pool:
+        results = pool.map(function, shard_ranges(count, jobs))
+    JOB_STATE.clear()
+    return results
+
+
+def compile_extracted_parallel(input_data, jobs):
+    prime_input_numbers(input_data)
+    items = list(input_data.items())
+    result = []
+    for shard in run_jobs(jobs, compile_shard, len(items), items=items):
+        result.extend(shard)
+    return result
+
+
+def convert_to_csv_parallel(output_data, processors, jobs):
+    column_defaults, fillers = make_fillers(processors)
+    blocks = run_jobs(jobs, fill_shard, len(output_data), records=output_data, defaults=column_defaults,
+                      fillers=fillers)
+    return finalize_columns(concat_columns(blocks))
+
+
+def init_pipeline_worker(parser, version, keep_extract):
+    global KEEP_EXTRACT
+    extract.init_extract_worker(parser, version)
+    KEEP_EXTRACT = keep_extract
+
+
+def compile_page(task):
+    try:
+        key, extracted, page_hash = extract.extract_page(task)
+        output_frame = {}
+        compile_information(extracted, output_frame)
+    except Exception:
+        # a malformed page is reported and skipped instead of stopping the pool
+        return task[0], None, None, None, traceback.format_exc()
+    if not KEEP_EXTRACT:
+        extracted = None
+    return key, output_frame, extracted, page_hash, None
+
+
+def compile_pages(pages_dir, worker_count, extract_dir=None):
+    extract.EXTRACTOR_VERSION = extract.extractor_version()
+    tasks = ((key, path, entry, None) for key, path, entry in extract.iter_page_tasks(pages_dir))
+    initargs = (extract.PARSER, extract.EXTRACTOR_VERSION, extract_dir is not None)
+    result = []
+    failed = 0
+    with mp.Pool(worker_count, initializer=init_pipeline_worker, initargs=initargs) as pool:
+        for key, output_frame, extracted, page_hash, error in pool.imap(compile_page, tasks, PIPELINE_CHUNK_SIZE):
+            if error is not None:
+                failed = failed + 1
+                print("Failed Compiling: %s\n%s" % (key, error), file=sys.stderr)
+                continue
+            print("Processing: " + key)
+            if extract_dir is not None:
+                with open(os.path.join(extract_dir, key), "w") as fp:
+                    json.dump(extracted, fp)
+                extract.append_manifest(extract_dir, key, page_hash)
+            if len(output_frame) > 0:
+                result.append(output_frame)
+    return result, failed
+
+
+def iter_compiled(extract_path, verbose=False):
+    for key, input_frame in extract.iter_json_from(extract_path):
+        if verbose:
+            print("Processing: " + key)
+        output_frame = {}
+        compile_information(input_frame, output_frame)
+        if len(output_frame) > 0:
+            yield output_frame
+
+
+def csv_batch_writer(path):
+    state = {"rows": 0, "batches": 0}
+
+    def write_batch(dataframe):
+        dataframe.index = range(state["rows"], state["rows"] + len(dataframe))
+        if state["batches"] == 0:
+            dataframe.to_csv(path)
+        else:
+            dataframe.to_csv(path, mode="a", header=False)
+        state["rows"] = state["rows"] + len(dataframe)
+        state["batches"] = state["batches"] + 1
+
+    def close():
+        pass
+
+    return write_batch, close
 
-    college_vector_map = find_colleges_csv(result)
-    aggregate_schools, school_map = find_schools_csv(result)
+
+def parquet_column_type(series):
+    import pyarrow as pa
+    if pd.api.types.is_bool_dtype(series):
+        return pa.bool_()
+    if pd.api.types.is_integer_dtype(series):
+        return pa.int64()
+    if pd.api.types.is_numeric_dtype(series):
+        return pa.float64()
+    return pa.string()
+
+
+def conform_to_schema(dataframe, schema):
+    import pyarrow as pa
+    columns = {}
+    for field in schema:
+        series = dataframe[field.name]
+        if field.type == pa.bool_():
+            columns[field.name] = series.astype(bool)
+        elif field.type == pa.int64():
+            columns[field.name] = series.astype(np.int64)
+        elif field.type == pa.float64():
+            columns[field.name] = pd.to_numeric(series, errors="coerce").astype(float)
+        else:
+            columns[field.name] = series.map(lambda val: None if val is None else str(val))
+    return pd.DataFrame(columns)
+
+
+def parquet_batch_writer(path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    state = {"writer": None, "schema": None}
+
+    # stream_compile casts every batch to the same dtypes, so the first batch fixes the schema
+    def write_batch(dataframe):
+        if state["writer"] is None:
+            state["schema"] = pa.schema([(col, parquet_column_type(dataframe[col])) for col in dataframe.columns])
+            state["writer"] = pq.ParquetWriter(path, state["schema"])
+        schema = state["schema"]
+        table = pa.Table.from_pandas(conform_to_schema(dataframe, schema), schema=schema, preserve_index=False)
+        state["writer"].write_table(table)
+
+    def close():
+        if state["writer"] is not None:
+            state["writer"].close()
+
+    return write_batch, close
+
+
+def sparse_indicator_builder(indicator_processors):
+    column_index = {}
+    terms_list = []
+    for processor in indicator_processors:
+        cols, terms = processor()
+        for col in cols:
+            if col not in column_index:
+                column_index[col] = len(column_index)
+        terms_list.append(terms)
+    indptr = [0]
+    indices = []
+
+    def add_rows(output_data):
+        for data in output_data:
+            if "models" not in data:
+                continue
+            for model in data["models"]:
+                row = set()
+                for terms in terms_list:
+                    for target in terms(model, data):
+                        row.add(column_index[target])
+                indices.extend(sorted(row))
+                indptr.append(len(indices))
+
+    def to_matrix():
+        import scipy.sparse
+        data = np.ones(len(indices), dtype=bool)
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, len(column_index)))
+
+    return list(column_index), add_rows, to_matrix
+
+
+def write_indicators(matrix, column_names):
+    import scipy.sparse
+    scipy.sparse.save_npz(INDICATORS_MATRIX, matrix)
+    with open(INDICATORS_VOCABULARY, "w") as fp:
+        json.dump(column_names, fp)
+
+
+def load_indicators(matrix_path=INDICATORS_MATRIX, vocabulary_path=INDICATORS_VOCABULARY):
+    import scipy.sparse
+    with open(vocabulary_path, "r") as fp:
+        column_names = json.load(fp)
+    return pd.DataFrame.sparse.from_spmatrix(scipy.sparse.load_npz(matrix_path), columns=column_names)
+
+
+def collect_stream_columns(compiled_data, batch_size):
+    vocabularies = collect_vocabularies([])
+    kinds = {}
+    batch = []
+    for data in compiled_data:
+        add_vocabulary(vocabularies, data)
+        batch.append(data)
+        if len(batch) >= batch_size:
+            add_column_kinds(kinds, batch, vocabularies)
+            batch = []
+    add_column_kinds(kinds, batch, vocabularies)
+    return vocabularies, kinds
+
+
+def add_column_kinds(kinds, batch, vocabularies):
+    column_defaults, fillers = make_fillers(build_processors(vocabularies, True))
+    columns = convert_rows(batch, column_defaults, fillers)
+    for col in columns:
+        if len(columns[col]) > 0:
+            kinds.setdefault(col, set()).add(columns[col].dtype.kind)
+
+
+def column_dtypes(column_defaults, kinds):
+    dtypes = {}
+    for col in column_defaults:
+        col_kinds = kinds.get(col, {value_kind(column_defaults[col])})
+        # the same promotion infer_objects applies when the whole column is converted at once
+        if len(col_kinds) == 1:
+            kind = next(iter(col_kinds))
+        elif col_kinds <= {"i", "f"}:
+            kind = "f"
+        else:
+            kind = "O"
+        dtypes[col] = KIND_DTYPES[kind]
+    return dtypes
+
+
+def cast_columns(columns, dtypes):
+    for col in columns:
+        if columns[col].dtype != dtypes[col]:
+            columns[col] = columns[col].astype(dtypes[col])
+    return pd.DataFrame(columns)
+
+
+def stream_compile(extract_path, table_format="csv", batch_size=STREAM_BATCH_SIZE, sparse=False, dense=False):
+    # column types come from the whole first pass so every batch is written with the same ones
+    vocabularies, kinds = collect_stream_columns(iter_compiled(extract_path), batch_size)
+    column_defaults, fillers = make_fillers(build_processors(vocabularies, sparse and not dense))
+    dtypes = column_dtypes(column_defaults, kinds)
+    if sparse:
+        indicator_names, add_indicator_rows, to_indicator_matrix = \
+            sparse_indicator_builder(build_indicator_processors(vocabularies))
+    if table_format == "parquet":
+        write_batch, close = parquet_batch_writer("compile.parquet")
+    else:
+        write_batch, close = csv_batch_writer("compile.csv")
+
+    record_count = 0
+    row_count = 0
+    batch = []
+    with open("compile.json", "w") as output_file:
+        output_file.write("[")
+        for output_frame in iter_compiled(extract_path, True):
+            if record_count > 0:
+                output_file.write(", ")
+            json.dump(output_frame, output_file)
+            record_count = record_count + 1
+            batch.append(output_frame)
+            if len(batch) >= batch_size:
+                if sparse:
+                    add_indicator_rows(batch)
+                dataframe = cast_columns(fill_columns(batch, column_defaults, fillers), dtypes)
+                write_batch(dataframe)
+                row_count = row_count + len(dataframe)
+                batch = []
+        output_file.write("]")
+    # the last batch is always written so an empty corpus still gets a header
+    if sparse:
+        add_indicator_rows(batch)
+        write_indicators(to_indicator_matrix(), indicator_names)
+    dataframe = cast_columns(fill_columns(batch, column_defaults, fillers), dtypes)
+    write_batch(dataframe)
+    row_count = row_count + len(dataframe)
+    close()
+    print("Len Result: " + str(record_count))
+    print("Len Dataframe: " + str(row_count))
+
+
+def build_processors(vocabularies, skip_indicators=False):
+    college_vector_map = vocabularies["colleges"]
+    aggregate_schools = vocabularies["school_types"]
 
     processors = [
         partial(copy_apartment_processor, {"name": "name", "city": "city", "state": "state",
@@ -632,16 +1083,60 @@ if __name__ == "__main__":
         partial(copy_apartment_processor, {"traffic_level": "traffic.level", "busi_level": "busi.level",
                                            "airport_level": "air.level"}, UNK_LABEL),
         partial(copy_model_processor,
-                {"beds": "beds", "baths": "baths", "rent": "rent", "sqft": "sqft", "available": "available"}, UNK_LABEL),
-        partial(features_processor, result),
-        partial(amenities_processor, result),
-        partial(school_name_processor, school_map),
-        partial(college_name_processor, college_vector_map)
+                {"beds": "beds", "baths": "baths", "rent": "rent", "sqft": "sqft", "available": "available"}, UNK_LABEL)
     ]
-    csv_dict = convert_to_csv(result, processors)
+    if not skip_indicators:
+        for indicator_processor in build_indicator_processors(vocabularies):
+            processors.append(partial(dense_indicator_processor, indicator_processor))
+    return processors
+
+
+def build_indicator_processors(vocabularies):
+    return [
+        partial(features_processor, vocabularies["features"]),
+        partial(amenities_processor, vocabularies["amenities"]),
+        partial(school_name_processor, vocabularies["schools"]),
+        partial(college_name_processor, vocabularies["colleges"])
+    ]
+
+
+if __name__ == "__main__":
+    extract.set_parser(cli.pop_option(sys.argv, "--parser", extract.PARSER))
+    sparse = cli.pop_flag(sys.argv, "--sparse")
+    dense = cli.pop_flag(sys.argv, "--dense")
+    jobs = int(cli.pop_option(sys.argv, "--jobs", 1))
+    if cli.pop_flag(sys.argv, "--stream"):
+        table_format = cli.pop_option(sys.argv, "--format", "csv")
+        batch_size = int(cli.pop_option(sys.argv, "--batch-size", STREAM_BATCH_SIZE))
+        stream_compile(sys.argv[1], table_format, batch_size, sparse, dense)
+        sys.exit(0)
+    failed = 0
+    pages_dir = cli.pop_option(sys.argv, "--pages")
+    if pages_dir is not None:
+        worker_count = int(cli.pop_option(sys.argv, "--workers", extract.PROCESS_COUNT))
+        keep_extract = cli.pop_option(sys.argv, "--keep-extract")
+        result, failed = compile_pages(pages_dir, worker_count, keep_extract)
+    elif jobs > 1:
+        result = compile_extracted_parallel(extract.load_json_from(sys.argv[1]), jobs)
+    else:
+        result = compile_extracted(extract.load_json_from(sys.argv[1]))
+
+    vocabularies = collect_vocabularies(result)
+    if sparse:
+        indicator_names, add_indicator_rows, to_indicator_matrix = \
+            sparse_indicator_builder(build_indicator_processors(vocabularies))
+        add_indicator_rows(result)
+        write_indicators(to_indicator_matrix(), indicator_names)
+    if jobs > 1:
+        csv_dict = convert_to_csv_parallel(result, build_processors(vocabularies, sparse and not dense), jobs)
+    else:
+        csv_dict = convert_to_csv(result, build_processors(vocabularies, sparse and not dense))
     dataframe = pd.DataFrame(csv_dict)
     print("Len Result: " + str(len(result)))
     print("Len Dataframe: " + str(len(dataframe)))
     with open("compile.json", "w") as output_file:
         json.dump(result, output_file)
     dataframe.to_csv("compile.csv")
+    if failed > 0:
+        print("Failed to compile %d pages" % failed)
+        sys.exit(1)
@@ -1,7 +1,9 @@
 import json
+import multiprocessing as mp
 import os
 import sys
 import time
+from multiprocessing.util import Finalize
 
 from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.chrome.options import Options
@@ -12,13 +14,36 @@ from selenium.webdriver.support.wait import WebDriverWait
 from seleniumwire import webdriver
 from selenium.webdriver.chrome.service import Service
 
+import cli
+import pagestore
 import scrape
 
 PAGE_DOWNLOAD_READY = scrape.config_file.get("MATCHING", "PAGE_DOWNLOAD_READY_XPATH")
 PAGE_DOWNLOAD_LOADED = scrape.config_file.get("MATCHING", "PAGE_DOWNLOAD_LOADED_XPATH")
 RETRY_COUNT = int(scrape.config_file.get("BASIC", "FETCH_RETRY"))
+WAIT = int(scrape.config_file.get("BASIC", "WAIT"))
+STABILIZE = scrape.config_file.get("BASIC", "STABILIZE")
+DOM_IDLE_MS = int(scrape.config_file.get("BASIC", "DOM_IDLE_MS"))
 
-if __name__ == "__main__":
+# resolves once the DOM has gone the given number of milliseconds without a mutation
+DOM_IDLE_SCRIPT = """
+var idle = arguments[0], timeout = arguments[1], done = arguments[arguments.length - 1];
+var start = Date.now(), last = start;
+var observer = new MutationObserver(function () { last = Date.now(); });
+observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+(function check() {
+    var now = Date.now();
+    if (now - last >= idle || now - start >= timeout) {
+        observer.disconnect();
+        done(now - start);
+    } else {
+        setTimeout(check, Math.min(idle, 50));
+    }
+})();
+"""
+
+
+def create_download_driver():
     config_file = scrape.config_file
     chrome_options = Options()
     chrome_param = config_file.get("BASIC", "DOWNLOAD_OPTIONS")
@@ -27,8 +52,91 @@ if __name__ == "__main__":
             chrome_options.add_argument(param.strip())
 
     driver = webdriver.Chrome(service=Service(config_file.get("BASIC", "DRIVER")), options=chrome_options)
-    wait = WebDriverWait(driver, int(config_file.get("BASIC", "WAIT")))
+    driver.set_script_timeout(WAIT + 1)
+    return driver
+
+
+def poll_page_source(driver):
+    final_page_source = driver.page_source
+    time.sleep(0.5)
+    while final_page_source != driver.page_source:
+        final_page_source = driver.page_source
+        time.sleep(0.1)
+    return final_page_source
+
+
+def wait_for_dom_idle(driver):
+    try:
+        driver.execute_async_script(DOM_IDLE_SCRIPT, DOM_IDLE_MS, WAIT * 1000)
+    except WebDriverException as e:
+        print(e)
+    return driver.page_source
+
+
+def fetch_page(driver, wait, url):
+    fetched = False
+
+    retry = 0
+    while not fetched and retry < RETRY_COUNT:
+        try:
+            driver.get(url)
+            wait.until(EC.presence_of_element_located((By.XPATH, PAGE_DOWNLOAD_READY)))
+            element = driver.find_element(By.XPATH, PAGE_DOWNLOAD_READY)
+            actions = ActionChains(driver)
+            actions.move_to_element(element).perform()
+            wait.until(EC.presence_of_element_located((By.XPATH, PAGE_DOWNLOAD_LOADED)))
+            fetched = True
+        except WebDriverException as e:
+            print(e)
+            pass
+        retry = retry + 1
+        if driver.current_url != url:
+            break
+    if not fetched:
+        return None, 0
+    time.sleep(scrape.get_next_sleep())
+    stabilize_start = time.time()
+    if STABILIZE == "poll":
+        final_page_source = poll_page_source(driver)
+    else:
+        final_page_source = wait_for_dom_idle(driver)
+    return final_page_source, time.time() - stabilize_start
 
+
+def init_download_worker(folder, store):
+    global driver, wait, block_stats, output_folder, use_store
+    output_folder = folder
+    use_store = store
+    driver = create_download_driver()
+    block_stats = scrape.install_request_blocker(driver)
+    wait = WebDriverWait(driver, WAIT)
+    # quit the browser when the pool shuts the worker down
+    Finalize(driver, driver.quit, exitpriority=10)
+
+
+def save_page(current, output):
+    if use_store:
+        segment = pagestore.writer_segment(output_folder, "pages-%d" % os.getpid())
+        pagestore.append_page(output_folder, segment, output)
+    else:
+        with open(os.path.join(output_folder, str(current) + ".json"), "w") as file:
+            file.write(json.dumps(output))
+
+
+def download_page(task):
+    current, url = task
+    html, stabilize_time = fetch_page(driver, wait, url)
+    traffic = scrape.collect_request_stats(driver, block_stats)
+    if html is None:
+        return current, url, False, 0, traffic
+    output = {"url": url, "time:": time.time(), "html": html}
+    save_page(current, output)
+    return current, url, True, stabilize_time, traffic
+
+
+if __name__ == "__main__":
+    worker_count = int(cli.pop_option(sys.argv, "--workers", 1))
+    use_store = cli.pop_flag(sys.argv, "--store")
     url_path = sys.argv[1]
     output_folder = sys.argv[2]
     os.makedirs(output_folder, exist_ok=True)
@@ -36,41 +144,54 @@ if __name__ == "__main__":
     urls = []
     with open(url_path, "r") as url_file:
         urls.extend(json.load(url_file))
-    current = 1
-    for url in urls:
-        output_path = os.path.join(output_folder, str(current) + ".json")
-        if os.path.exists(output_path):
-            current = current + 1
-            continue
-        fetched = False
-
-        retry = 0
-        while not fetched and retry < RETRY_COUNT:
-            try:
-                driver.get(url)
-                wait.until(EC.presence_of_element_located((By.XPATH, PAGE_DOWNLOAD_READY)))
-                element = driver.find_element(By.XPATH, PAGE_DOWNLOAD_READY)
-                actions = ActionChains(driver)
-                actions.move_to_element(element).perform()
-                wait.until(EC.presence_of_element_located((By.XPATH, PAGE_DOWNLOAD_LOADED)))
-                fetched = True
-            except WebDriverException as e:
-                print(e)
-                pass
-            retry = retry + 1
-            if driver.current_url != url:
-                break
-        if fetched:
-            time.sleep(scrape.get_next_sleep())
-            final_page_source = driver.page_source
-            time.sleep(0.5)
-            while final_page_source != driver.page_source:
-                final_page_source = driver.page_source
-                time.sleep(0.1)
-            output = {"url": url, "time:": time.time(), "html": final_page_source}
-            with open(output_path, "w") as file:
-                file.write(json.dumps(output))
-            print("Downloaded: %d/%d pages" % (current, len(urls)))
-        else:
-            print("Skipped: " + url)
-        current = current + 1
+    stored = {}
+    if use_store:
+        stored = pagestore.load_index(output_folder)
+    tasks = []
+    for current, url in enumerate(urls, 1):
+        if use_store:
+            if pagestore.url_key(url) not in stored:
+                tasks.append((current, url))
+        elif not os.path.exists(os.path.join(output_folder, str(current) + ".json")):
+            tasks.append((current, url))
+
+    pool = None
+    if worker_count > 1:
+        pool = mp.Pool(worker_count, initializer=init_download_worker, initargs=(output_folder, use_store))
+        downloads = pool.imap_unordered(download_page, tasks)
+    else:
+        init_download_worker(output_folder, use_store)
+        downloads = map(download_page, tasks)
+
+    start_time = time.time()
+    downloaded = 0
+    total_stabilize_time = 0
+    total_traffic = [0, 0, 0]
+    try:
+        for current, url, fetched, stabilize_time, traffic in downloads:
+            requests, blocked, received = traffic
+            for i in range(len(total_traffic)):
+                total_traffic[i] = total_traffic[i] + traffic[i]
+            if fetched:
+                downloaded = downloaded + 1
+                total_stabilize_time = total_stabilize_time + stabilize_time
+                pages_per_minute = downloaded / (time.time() - start_time) * 60
+                print("Downloaded: %d/%d pages (%.1f pages/min, stable after %.2fs)"
+                      % (current, len(urls), pages_per_minute, stabilize_time))
+                print("Requests: %d, blocked: %d, received: %.1f KB" % (requests, blocked, received / 1024))
+            else:
+                print("Skipped: " + url)
+        if downloaded > 0:
+            print("Average wait for a stable page (%s): %.2fs" % (STABILIZE, total_stabilize_time / downloaded))
+            print("Average per page: %.1f requests, %.1f blocked, %.1f KB received"
+                  % (total_traffic[0] / downloaded, total_traffic[1] / downloaded,
+                     total_traffic[2] / downloaded / 1024))
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
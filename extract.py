@@ -1,90 +1,154 @@
+import copy
+import hashlib
 import json
 import multiprocessing as mp
 import os
 import re
 import sys
+import threading
+import time
+import traceback
+import tracemalloc
 
 import bs4
+import soupsieve as sv
 
+import cli
+import pagestore
 import scrape
 
-PROCESS_COUNT = 11
+# records the page hash and extractor version behind each output file, named so load_json_from skips it
+MANIFEST_FILE = "extract.manifest"
+EXTRACTOR_VERSION = None
 
 config_file = scrape.config_file
-PROPERTY_HEADER_SECTION_SELECTOR = "div.profilePropertyInfoWrapper#propertyHeader"
-PROPERTY_NAME_SELECTOR = "h1#propertyName"
-PROPERTY_ADDRESS_SECTION_SELECTOR = "div.propertyAddressContainer"
-ADDRESS_PART_SELECTOR = "h2 span"
-BREAD_SELECTOR = "div[id='breadcrumbs-container']"
-CRUMB_SELECTOR = "span[class='crumb']"
-
-DESC_SECTION_SELECTOR = "section#descriptionSection"
-CUSTOM_DESC_SELECTOR = "p"
-UNIQUE_FEATURE_SELECTOR = "div#uniqueFeatures"
-UNIQUE_LIST_ITEM_SELECTOR = "ul li span"
-
-AMENITIES_SELECTOR = "section#amenitiesSection"
-AMENITIES_CARD_SELECTOR = "div.amenityCard"
-AMENITIES_LABEL_SELECTOR = "p.amenityLabel"
-AMENITIES_LIST_SELECTOR = "ul li span"
-
-FEE_SECTION_SELECTOR = "section#feesSection > div"
-FEE_TITLES_SELECTOR = "h3.feePolicyTitle"
-FEE_SECTION_NOTE_SELECTOR = "div.clampWrapper"
-FEE_SECTION_HEADER_SELECTOR = "h4.header-column"
-FEE_SECTION_NOTE_LABEL_SELECTOR = "span"
-FEE_SECTION_LIST_SELECTOR = "ul li"
-FEE_SECTION_LIST_ROW_SELECTOR = "div.component-row"
-
-NEIGHBOR_SECTION_SELECTOR = "section#subMarketSection"
-NEIGHBOR_TEXT_SELECTOR = "div.overViewWrapper"
-
-EDUC_SECTION_SELECTOR = "div#educationContainer"
-EDUC_COLLEGE_SELECTOR = "div#profilev2College"
-
-SCHOOL_SECTION_SELECTOR = "div#profilev2SchoolsModule"
-PUBLIC_SCHOOL_SECTION_SELECTOR = "div.schoolsPublicContainer"
-PRIVATE_SCHOOL_SECTION_SELECTOR = "div.schoolsPrivateContainer"
-SCHOOL_CARD_SELECTOR = "div.card"
-SCHOOL_CARD_NAME_SELECTOR = "div.title"
-SCHOOL_CARD_TYPE_SELECTOR = "div.subtitle"
-SCHOOL_CARD_ATTR_SELECTOR = "div.bodyTextLine"
-SCHOOL_CARD_ZONE_SELECTOR = "div.nearbySchools span"
-
-TRANSPORTATION_HEAD_SELECTOR = "thead.longLabel th.headerCol1"
-TRANSPORTATION_DETAIL_SECTION_SELECTOR = "div.transportationDetail"
-TRANSPORTATION_SECTION_SELECTOR = "section#transportationSection"
-TRANSPORTATION_SELECTOR = "div.transportationDetail table tbody"
-WALK_SCORE_SELECTOR = "div#transportationScoreCard > div.walkScore div.score"
-TRANSIT_SCORE_SELECTOR = "div#transportationScoreCard > div.transitScore div.score"
-BIKE_SCORE_SELECTOR = "div#transportationScoreCard > div.bikeScore div.score"
-SOUND_SCORE_SECTION_SELECTOR = "div#soundScoreSection"
-SOUND_SCORE_SELECTOR = "div.score"
-TRAFFIC_LEVEL_SELECTOR = "div.soundScoreCategory span.ssTrafficData"
-AIRPORT_LEVEL_SELECTOR = "div.soundScoreCategory span.ssAirportsData"
-BUSI_LEVEL_SELECTOR = "div.soundScoreCategory span.ssBusinessData"
-
-PRICE_SECTION_SELECTOR = "div#pricingView"
-PRICE_MODEL_SELECTOR = "div[data-tab-content-id='all'] div.pricingGridItem"
-PRICE_MODEL_OVERVIEW_SELECTOR = "div.priceBedRangeInfo"
-MODEL_NAME_SELECTOR = "span.modelName"
-MODEL_RENT_SELECTOR = "span.rentLabel"
-MODEL_DETAILS_SELECTOR = "h4.detailsLabel span.detailsTextWrapper > span"
-MODEL_FEATURES_SELECTOR = "ul.allAmenities li ul li"
-MODEL_UNITS_SELECTOR = "li.unitContainer"
-MODEL_UNITS_SQFT_SELECTOR = "div.sqftColumn span:nth-child(2)"
-MODEL_UNITS_RENT_SELECTOR = "div.pricingColumn span:nth-child(2)"
-
-TOP_MODEL_SELECTOR = "ul[class='priceBedRangeInfo']"
-TOP_INFO_SEGMENT_SELECTOR = "div[class='priceBedRangeInfoInnerContainer']"
-TOP_INFO_NAME_SELECTOR = "p[class='rentInfoLabel']"
-TOP_INFO_CONTENT_SELECTOR = "p[class='rentInfoDetail']"
+PARSER = config_file.get("EXTRACT", "PARSER")
+PARSER_BACKENDS = ["html.parser", "lxml", "html5lib"]
+# html5lib builds the whole tree and warns on every page if given a strainer
+UNSTRAINED_PARSERS = ["html5lib"]
+STRAIN = config_file.getboolean("EXTRACT", "STRAIN")
+# 0 sizes the pool to the cpu count
+PROCESS_COUNT = config_file.getint("EXTRACT", "WORKERS") or os.cpu_count() or 1
+CHUNK_SIZE = config_file.getint("EXTRACT", "CHUNK_SIZE")
+# chunks handed to each worker that have not been written out yet
+CHUNKS_IN_FLIGHT = 4
+PROPERTY_HEADER_SECTION_SELECTOR = sv.compile("div.profilePropertyInfoWrapper#propertyHeader")
+PROPERTY_NAME_SELECTOR = sv.compile("h1#propertyName")
+PROPERTY_ADDRESS_SECTION_SELECTOR = sv.compile("div.propertyAddressContainer")
+ADDRESS_PART_SELECTOR = sv.compile("h2 span")
+CRUMB_SELECTOR = sv.compile("div[id='breadcrumbs-container'] span[class='crumb']")
+
+DESC_SECTION_SELECTOR = sv.compile("section#descriptionSection")
+CUSTOM_DESC_SELECTOR = sv.compile("p")
+UNIQUE_FEATURE_SELECTOR = sv.compile("div#uniqueFeatures")
+UNIQUE_LIST_ITEM_SELECTOR = sv.compile("ul li span")
+
+AMENITIES_SELECTOR = sv.compile("section#amenitiesSection")
+AMENITIES_LABEL_SELECTOR = sv.compile("div.amenityCard p.amenityLabel")
+AMENITIES_LIST_SELECTOR = sv.compile("ul li span")
+
+FEES_SELECTOR = sv.compile("section#feesSection")
+FEE_SECTION_SELECTOR = sv.compile(":scope > div")
+FEE_TITLES_SELECTOR = sv.compile("h3.feePolicyTitle")
+FEE_SECTION_NOTE_SELECTOR = sv.compile("div.clampWrapper")
+FEE_SECTION_HEADER_SELECTOR = sv.compile("h4.header-column")
+FEE_SECTION_NOTE_LABEL_SELECTOR = sv.compile("span")
+FEE_SECTION_LIST_SELECTOR = sv.compile("ul li")
+FEE_SECTION_LIST_ROW_SELECTOR = sv.compile("div.component-row")
+
+NEIGHBOR_SECTION_SELECTOR = sv.compile("section#subMarketSection")
+NEIGHBOR_TEXT_SELECTOR = sv.compile("div.overViewWrapper")
+
+EDUC_SECTION_SELECTOR = sv.compile("div#educationContainer")
+EDUC_COLLEGE_SELECTOR = sv.compile("div#profilev2College")
+
+SCHOOL_SECTION_SELECTOR = sv.compile("div#profilev2SchoolsModule")
+PUBLIC_SCHOOL_SECTION_SELECTOR = sv.compile("div.schoolsPublicContainer")
+PRIVATE_SCHOOL_SECTION_SELECTOR = sv.compile("div.schoolsPrivateContainer")
+SCHOOL_CARD_SELECTOR = sv.compile("div.card")
+SCHOOL_CARD_NAME_SELECTOR = sv.compile("div.title")
+SCHOOL_CARD_TYPE_SELECTOR = sv.compile("div.subtitle")
+SCHOOL_CARD_ATTR_SELECTOR = sv.compile("div.bodyTextLine")
+SCHOOL_CARD_ZONE_SELECTOR = sv.compile("div.nearbySchools span")
+
+TRANSPORTATION_HEAD_SELECTOR = sv.compile("thead.longLabel th.headerCol1")
+TRANSPORTATION_DETAIL_SECTION_SELECTOR = sv.compile("div.transportationDetail")
+TRANSPORTATION_SECTION_SELECTOR = sv.compile("section#transportationSection")
+TRANSPORTATION_SELECTOR = sv.compile("div.transportationDetail table tbody")
+TABLE_ROW_SELECTOR = sv.compile("tr")
+TABLE_CELL_SELECTOR = sv.compile("td")
+SCORE_CARD_SELECTOR = sv.compile("div#transportationScoreCard")
+WALK_SCORE_SELECTOR = sv.compile(":scope > div.walkScore div.score")
+TRANSIT_SCORE_SELECTOR = sv.compile(":scope > div.transitScore div.score")
+BIKE_SCORE_SELECTOR = sv.compile(":scope > div.bikeScore div.score")
+SOUND_SCORE_SECTION_SELECTOR = sv.compile("div#soundScoreSection")
+SOUND_SCORE_SELECTOR = sv.compile("div.score")
+TRAFFIC_LEVEL_SELECTOR = sv.compile("div.soundScoreCategory span.ssTrafficData")
+AIRPORT_LEVEL_SELECTOR = sv.compile("div.soundScoreCategory span.ssAirportsData")
+BUSI_LEVEL_SELECTOR = sv.compile("div.soundScoreCategory span.ssBusinessData")
+
+PRICE_SECTION_SELECTOR = sv.compile("div#pricingView")
+PRICE_MODEL_SELECTOR = sv.compile("div[data-tab-content-id='all'] div.pricingGridItem")
+PRICE_MODEL_OVERVIEW_SELECTOR = sv.compile("div.priceBedRangeInfo")
+MODEL_NAME_SELECTOR = sv.compile("span.modelName")
+MODEL_RENT_SELECTOR = sv.compile("span.rentLabel")
+MODEL_DETAILS_SELECTOR = sv.compile("h4.detailsLabel span.detailsTextWrapper > span")
+MODEL_FEATURES_SELECTOR = sv.compile("ul.allAmenities li ul li")
+MODEL_UNITS_SELECTOR = sv.compile("li.unitContainer")
+MODEL_UNITS_SQFT_SELECTOR = sv.compile("div.sqftColumn span:nth-child(2)")
+MODEL_UNITS_RENT_SELECTOR = sv.compile("div.pricingColumn span:nth-child(2)")
+
+TOP_MODEL_SELECTOR = sv.compile("ul[class='priceBedRangeInfo']")
+TOP_INFO_SEGMENT_SELECTOR = sv.compile("div[class='priceBedRangeInfoInnerContainer']")
+TOP_INFO_NAME_SELECTOR = sv.compile("p[class='rentInfoLabel']")
+TOP_INFO_CONTENT_SELECTOR = sv.compile("p[class='rentInfoDetail']")
+TOP_INFO_ITEM_SELECTOR = sv.compile("li")
 
 STATE_ZIP_REGEX = "stateZipContainer"
 NEIGHBOR_REGEX = "neighborhoodAddress"
 ADDRESS_REGEX = "delivery-address"
 
 
+def is_strained_section(attrs):
+    # only the sections located by PAGE_SCHEMA are parsed
+    if attrs.get("id") in SECTIONS_BY_ID or attrs.get("id") in KEPT_IDS:
+        return True
+    classes = attrs.get("class") or []
+    if isinstance(classes, str):
+        classes = classes.split()
+    for cls in classes:
+        if cls in SECTIONS_BY_CLASS or cls in KEPT_CLASSES:
+            return True
+    return False
+
+
+class SectionStrainer(bs4.SoupStrainer):
+    # the parser only consults the strainer for top level elements, so a kept section keeps its whole subtree
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return is_strained_section(attrs or {})
+
+    def allow_string_creation(self, string):
+        return False
+
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        # bs4 releases before 4.13 call this instead of allow_tag_creation
+        if isinstance(markup_name, bs4.Tag):
+            return markup_name if is_strained_section(markup_name.attrs) else None
+        return is_strained_section(dict(markup_attrs))
+
+
+SECTION_STRAINER = SectionStrainer()
+
+
+def make_soup(html, strain=None):
+    if strain is None:
+        strain = STRAIN
+    if PARSER in UNSTRAINED_PARSERS:
+        strain = False
+    return bs4.BeautifulSoup(html, PARSER, parse_only=SECTION_STRAINER if strain else None)
+
+
 def extract_address_part(index, part, output_data):
     if "class" not in part.attrs:
         return
@@ -102,65 +166,11 @@ def extract_address_part(index, part, output_data):
         return
 
 
-def extract_header(soup, output_data):
-    header_section = soup.select_one(PROPERTY_HEADER_SECTION_SELECTOR)
-    bread_section = header_section.select_one(BREAD_SELECTOR)
-    crumbs = bread_section.select(CRUMB_SELECTOR)
-    address_section = header_section.select_one(PROPERTY_ADDRESS_SECTION_SELECTOR)
-    address_parts = address_section.select(ADDRESS_PART_SELECTOR)
+def extract_address(header_section, output_data):
+    address_section = PROPERTY_ADDRESS_SECTION_SELECTOR.select_one(header_section)
+    address_parts = ADDRESS_PART_SELECTOR.select(address_section)
     for i, part in enumerate(address_parts):
         extract_address_part(i, part, output_data)
-    property_name = soup.select_one(PROPERTY_NAME_SELECTOR)
-    output_data["name"] = property_name.get_text().strip()
-    output_data["type"] = crumbs[0].text.strip()
-    output_data["city"] = crumbs[2].text.strip()
-
-
-def extract_apartment_desc(soup, output_data):
-    output_data["custom_desc"] = {}
-    desc_section = soup.select_one(DESC_SECTION_SELECTOR)
-    if desc_section is None:
-        return
-    custom_desc = desc_section.select_one(CUSTOM_DESC_SELECTOR)
-    if custom_desc is not None and len(custom_desc.attrs) == 0:
-        output_data["custom_desc"]["text"] = custom_desc.get_text()
-
-    unique_section = soup.select_one(UNIQUE_FEATURE_SELECTOR)
-    items = []
-    if unique_section is not None:
-        unique_list = unique_section.select(UNIQUE_LIST_ITEM_SELECTOR)
-        for item in unique_list:
-            items.append(item.get_text().strip())
-        items = list(set(items))
-        output_data["custom_desc"]["unique_feature"] = items
-
-
-def extract_amenities_cards(soup):
-    cards = soup.select(AMENITIES_CARD_SELECTOR)
-    result = []
-    for card in cards:
-        label = card.select_one(AMENITIES_LABEL_SELECTOR)
-        if label is not None:
-            result.append(label.get_text().strip())
-    return result
-
-
-def extract_amenities_lists(soup):
-    list_items = soup.select(AMENITIES_LIST_SELECTOR)
-    result = []
-    for item in list_items:
-        result.append(item.get_text().strip())
-    return result
-
-
-def extract_amenities(soup, output_data):
-    amenities_section = soup.select_one(AMENITIES_SELECTOR)
-    if amenities_section is None:
-        return
-    result = []
-    result.extend(extract_amenities_cards(amenities_section))
-    result.extend(extract_amenities_lists(amenities_section))
-    output_data["amenities"] = list(set(result))
 
 
 def clean_for_json_attr(string):
@@ -170,9 +180,9 @@ def clean_for_json_attr(string):
 
 
 def extract_fee_section_note(soup, content_list):
-    note_section = soup.select_one(FEE_SECTION_NOTE_SELECTOR)
+    note_section = FEE_SECTION_NOTE_SELECTOR.select_one(soup)
     if note_section is not None:
-        note_label = note_section.select_one(FEE_SECTION_NOTE_LABEL_SELECTOR)
+        note_label = FEE_SECTION_NOTE_LABEL_SELECTOR.select_one(note_section)
         note_label_text = "note"
         if note_label is not None:
             note_label_text = note_label.get_text().strip()
@@ -181,9 +191,9 @@ def extract_fee_section_note(soup, content_list):
 
 
 def extract_fee_section_table(soup, content_list):
-    section_list = soup.select(FEE_SECTION_LIST_SELECTOR)
+    section_list = FEE_SECTION_LIST_SELECTOR.select(soup)
     for item in section_list:
-        row_elements = list(item.select(FEE_SECTION_LIST_ROW_SELECTOR))
+        row_elements = list(FEE_SECTION_LIST_ROW_SELECTOR.select(item))
         if len(row_elements) == 0:
             continue
         key_pair = list(row_elements[0].findChildren("div", recursive=False))
@@ -199,7 +209,7 @@ def extract_fee_section_table(soup, content_list):
 
 
 def extract_fee_section(soup, output_list):
-    header_col = soup.select_one(FEE_SECTION_HEADER_SELECTOR)
+    header_col = FEE_SECTION_HEADER_SELECTOR.select_one(soup)
     if header_col is None:
         return
     name = header_col.get_text().strip()
@@ -214,12 +224,12 @@ def extract_fee_section(soup, output_list):
         output_list.append(section_data)
 
 
-def extract_fees(soup, output_data):
-    fee_section = soup.select_one(FEE_SECTION_SELECTOR)
+def extract_fees(fees_section, output_data):
+    fee_section = FEE_SECTION_SELECTOR.select_one(fees_section)
     if fee_section is None:
         return
     output_data["fees"] = {}
-    fee_policy_titles = fee_section.select(FEE_TITLES_SELECTOR)
+    fee_policy_titles = FEE_TITLES_SELECTOR.select(fee_section)
     for title in fee_policy_titles:
         title_attr = title.get_text().strip()
         output_data["fees"][title_attr] = []
@@ -231,30 +241,22 @@ def extract_fees(soup, output_data):
             next_sibling = next_sibling.find_next_sibling()
 
 
-def extract_neighbor_desc(soup, output_data):
-    neighbor_section = soup.select_one(NEIGHBOR_SECTION_SELECTOR)
-    if neighbor_section is not None:
-        neighbor_text_section = neighbor_section.select_one(NEIGHBOR_TEXT_SELECTOR)
-        neighbor_section_text = neighbor_text_section.get_text().strip()
-        output_data["neighborhood_desc"] = neighbor_section_text
-
-
 def extract_transportation(soup):
-    transportation_section = soup.select_one(TRANSPORTATION_SELECTOR)
+    transportation_section = TRANSPORTATION_SELECTOR.select_one(soup)
     if transportation_section is None:
         return []
-    transportation_infos = transportation_section.select("tr")
+    transportation_infos = TABLE_ROW_SELECTOR.select(transportation_section)
     result = []
     for row in transportation_infos:
         row_list = []
-        for col in row.select("td"):
+        for col in TABLE_CELL_SELECTOR.select(row):
             row_list.append(col.get_text().strip())
         result.append(row_list)
     return result
 
 
 def extract_colleges(soup, output_data):
-    college_section = soup.select_one(EDUC_COLLEGE_SELECTOR)
+    college_section = EDUC_COLLEGE_SELECTOR.select_one(soup)
     if college_section is None:
         return
     college_transportation = extract_transportation(college_section)
@@ -263,13 +265,13 @@ def extract_colleges(soup, output_data):
 
 
 def extract_school_info(soup):
-    school_cards = soup.select(SCHOOL_CARD_SELECTOR)
+    school_cards = SCHOOL_CARD_SELECTOR.select(soup)
     result = []
     for card in school_cards:
-        name_elt = card.select_one(SCHOOL_CARD_NAME_SELECTOR)
-        type_elt = card.select_one(SCHOOL_CARD_TYPE_SELECTOR)
-        zone_elt = card.select_one(SCHOOL_CARD_ZONE_SELECTOR)
-        attribute_elts = card.select(SCHOOL_CARD_ATTR_SELECTOR)
+        name_elt = SCHOOL_CARD_NAME_SELECTOR.select_one(card)
+        type_elt = SCHOOL_CARD_TYPE_SELECTOR.select_one(card)
+        zone_elt = SCHOOL_CARD_ZONE_SELECTOR.select_one(card)
+        attribute_elts = SCHOOL_CARD_ATTR_SELECTOR.select(card)
         attributes = []
         for attr in attribute_elts:
             attributes.append(attr.get_text().strip())
@@ -282,12 +284,12 @@ def extract_school_info(soup):
 
 
 def extract_schools(soup, output_data):
-    public_school_section = soup.select_one(PUBLIC_SCHOOL_SECTION_SELECTOR)
+    public_school_section = PUBLIC_SCHOOL_SECTION_SELECTOR.select_one(soup)
     if public_school_section is not None:
         public_schools = extract_school_info(public_school_section)
         if len(public_schools) > 0:
             output_data["public_schools"] = public_schools
-    private_school_section = soup.select_one(PRIVATE_SCHOOL_SECTION_SELECTOR)
+    private_school_section = PRIVATE_SCHOOL_SECTION_SELECTOR.select_one(soup)
     if private_school_section is not None:
         private_schools = extract_school_info(private_school_section)
         if len(private_schools) > 0:
@@ -295,9 +297,6 @@ def extract_schools(soup, output_data):
 
 
 def extract_education(soup, output_data):
-    education_section = soup.select_one(EDUC_SECTION_SELECTOR)
-    if education_section is None:
-        return
     education_data = {}
     extract_colleges(soup, education_data)
     extract_schools(soup, education_data)
@@ -306,7 +305,7 @@ def extract_education(soup, output_data):
 
 
 def extract_transportation_details(soup):
-    transportation_head = soup.select_one(TRANSPORTATION_HEAD_SELECTOR)
+    transportation_head = TRANSPORTATION_HEAD_SELECTOR.select_one(soup)
     if transportation_head is None:
         return None
     head_text = transportation_head.get_text().strip()
@@ -316,10 +315,7 @@ def extract_transportation_details(soup):
 
 
 def extract_nearby_transportation(soup, output_data):
-    transportation_section = soup.select_one(TRANSPORTATION_SECTION_SELECTOR)
-    if transportation_section is None:
-        return
-    transportation_details = soup.select(TRANSPORTATION_DETAIL_SECTION_SELECTOR)
+    transportation_details = TRANSPORTATION_DETAIL_SECTION_SELECTOR.select(soup)
     detail_list = []
     for detail in transportation_details:
         detail_item = extract_transportation_details(detail)
@@ -330,49 +326,15 @@ def extract_nearby_transportation(soup, output_data):
         output_data["transportation"] = detail_list
 
 
-def extract_environment(soup, output_data):
-    transit_score = soup.select_one(TRANSIT_SCORE_SELECTOR)
-    bike_score = soup.select_one(BIKE_SCORE_SELECTOR)
-    walk_score = soup.select_one(WALK_SCORE_SELECTOR)
-
-    data_entry = {}
-    if transit_score is not None:
-        data_entry["transit_score"] = transit_score.get_text().strip()
-
-    if bike_score is not None:
-        data_entry["bike_score"] = bike_score.get_text().strip()
-
-    if walk_score is not None:
-        data_entry["walk_score"] = walk_score.get_text().strip()
-
-    sound_score_section = soup.select_one(SOUND_SCORE_SECTION_SELECTOR)
-    if sound_score_section is not None:
-        sound_score = sound_score_section.select_one(SOUND_SCORE_SELECTOR)
-        traffic_level = sound_score_section.select_one(TRAFFIC_LEVEL_SELECTOR)
-        busi_level = sound_score_section.select_one(BUSI_LEVEL_SELECTOR)
-        airport_level = sound_score_section.select_one(AIRPORT_LEVEL_SELECTOR)
-        if sound_score is not None:
-            data_entry["sound_score"] = sound_score.get_text().strip()
-        if traffic_level is not None:
-            data_entry["traffic_level"] = traffic_level.get_text().strip()
-        if busi_level is not None:
-            data_entry["busi_level"] = busi_level.get_text().strip()
-        if airport_level is not None:
-            data_entry["airport_level"] = airport_level.get_text().strip()
-
-    if len(data_entry) > 0:
-        output_data["environment"] = data_entry
-
-
 def extract_individual_model(soup):
     result = {}
-    overview_section = soup.select_one(PRICE_MODEL_OVERVIEW_SELECTOR)
+    overview_section = PRICE_MODEL_OVERVIEW_SELECTOR.select_one(soup)
     if overview_section is None:
         return None
 
-    name = overview_section.select_one(MODEL_NAME_SELECTOR)
-    rent = overview_section.select_one(MODEL_RENT_SELECTOR)
-    details = overview_section.select(MODEL_DETAILS_SELECTOR)
+    name = MODEL_NAME_SELECTOR.select_one(overview_section)
+    rent = MODEL_RENT_SELECTOR.select_one(overview_section)
+    details = MODEL_DETAILS_SELECTOR.select(overview_section)
     result["name"] = name.get_text().strip()
     result["rent"] = rent.get_text().strip()
     detail_list = []
@@ -380,7 +342,7 @@ def extract_individual_model(soup):
         detail_list.append(detail.get_text().strip())
     result["details"] = detail_list
 
-    features = soup.select(MODEL_FEATURES_SELECTOR)
+    features = MODEL_FEATURES_SELECTOR.select(soup)
     feature_list = []
     for feature in features:
         feature_list.append(feature.get_text().strip())
@@ -388,14 +350,14 @@ def extract_individual_model(soup):
     if len(feature_list) > 0:
         result["features"] = feature_list
 
-    model_units = soup.select(MODEL_UNITS_SELECTOR)
+    model_units = MODEL_UNITS_SELECTOR.select(soup)
     unit_list = []
     for unit in model_units:
         attributes = unit.attrs
         unit_data = {"name": attributes["data-unit"]}
-        sqft_elt = unit.select_one(MODEL_UNITS_SQFT_SELECTOR)
+        sqft_elt = MODEL_UNITS_SQFT_SELECTOR.select_one(unit)
         unit_data["sqft"] = sqft_elt.get_text().strip()
-        rent_elt = unit.select_one(MODEL_UNITS_RENT_SELECTOR)
+        rent_elt = MODEL_UNITS_RENT_SELECTOR.select_one(unit)
         unit_data["rent"] = rent_elt.get_text().strip()
         unit_list.append(unit_data)
     if len(unit_list) > 0:
@@ -404,9 +366,9 @@ def extract_individual_model(soup):
         return result
 
 
-def extract_units_model(output_data, price_section):
+def extract_units_model(price_section, output_data):
     models = []
-    for model in price_section.select(PRICE_MODEL_SELECTOR):
+    for model in PRICE_MODEL_SELECTOR.select(price_section):
         indi_model = extract_individual_model(model)
         if indi_model is not None:
             models.append(indi_model)
@@ -414,17 +376,16 @@ def extract_units_model(output_data, price_section):
         output_data["models"] = models
 
 
-def extract_whole_model(soup, output_data):
+def extract_whole_model(info_bar, output_data):
+    if output_data.get("type") == "Home":
+        return
     model = {}
     details = ["", "", ""]
     model["name"] = "self"
     model["features"] = []
-    info_bar = soup.select_one(TOP_MODEL_SELECTOR)
-    if info_bar is None:
-        return
-    for info in info_bar.select("li"):
-        info_name = info.select_one(TOP_INFO_NAME_SELECTOR).text.strip().lower()
-        info_content = info.select_one(TOP_INFO_CONTENT_SELECTOR).text.strip()
+    for info in TOP_INFO_ITEM_SELECTOR.select(info_bar):
+        info_name = TOP_INFO_NAME_SELECTOR.select_one(info).text.strip().lower()
+        info_content = TOP_INFO_CONTENT_SELECTOR.select_one(info).text.strip()
 
         if info_name == "monthly rent":
             model["rent"] = info_content
@@ -438,54 +399,440 @@ def extract_whole_model(soup, output_data):
     output_data["models"] = [model]
 
 
-def extract_model(soup, output_data):
-    price_section = soup.select_one(PRICE_SECTION_SELECTOR)
-    if price_section is not None:
-        extract_units_model(output_data, price_section)
-    elif output_data["type"] != "Home":
-        extract_whole_model(soup, output_data)
+# layout of a listing page: every section is found in a single walk over the document, by the id or class in
+# "locate" and its "root" selector. Its "fields" are then read from inside the section and any "extract" function
+# fills in what needs more than a selector, given the whole document instead with "document". Elements matching
+# "keep" survive the strainer outside the sections. A section is skipped when a section in "unless" is found or one
+# in "requires" is missing. A field takes the text of its first match, of the "index"th match or, with "all", of
+# every match.
+PAGE_SCHEMA = {
+    "header": {
+        "locate": ("id", "propertyHeader"), "root": PROPERTY_HEADER_SECTION_SELECTOR,
+        "extract": extract_address,
+        "fields": [
+            {"key": ["type"], "select": CRUMB_SELECTOR, "index": 0},
+            {"key": ["city"], "select": CRUMB_SELECTOR, "index": 2}
+        ]
+    },
+    "name": {
+        "locate": ("id", "propertyName"), "root": PROPERTY_NAME_SELECTOR,
+        "fields": [{"key": ["name"]}]
+    },
+    "description": {
+        "locate": ("id", "descriptionSection"), "root": DESC_SECTION_SELECTOR,
+        "init": {"custom_desc": {}},
+        "fields": [{"key": ["custom_desc", "text"], "select": CUSTOM_DESC_SELECTOR, "strip": False, "no_attrs": True}]
+    },
+    "unique_features": {
+        "locate": ("id", "uniqueFeatures"), "root": UNIQUE_FEATURE_SELECTOR,
+        "requires": ["description"],
+        "fields": [{"key": ["custom_desc", "unique_feature"], "select": UNIQUE_LIST_ITEM_SELECTOR, "all": True,
+                    "dedupe": True}]
+    },
+    "amenities": {
+        "locate": ("id", "amenitiesSection"), "root": AMENITIES_SELECTOR,
+        "fields": [{"key": ["amenities"], "select": [AMENITIES_LABEL_SELECTOR, AMENITIES_LIST_SELECTOR], "all": True,
+                    "dedupe": True}]
+    },
+    "fees": {
+        "locate": ("id", "feesSection"), "root": FEES_SELECTOR,
+        "extract": extract_fees
+    },
+    "neighborhood": {
+        "locate": ("id", "subMarketSection"), "root": NEIGHBOR_SECTION_SELECTOR,
+        "fields": [{"key": ["neighborhood_desc"], "select": NEIGHBOR_TEXT_SELECTOR}]
+    },
+    "education": {
+        "locate": ("id", "educationContainer"), "root": EDUC_SECTION_SELECTOR,
+        # colleges and schools are read from the whole page once the section is present
+        "document": True,
+        "keep": [("id", "profilev2College"), ("class", "schoolsPublicContainer"), ("class", "schoolsPrivateContainer")],
+        "extract": extract_education
+    },
+    "transportation": {
+        "locate": ("id", "transportationSection"), "root": TRANSPORTATION_SECTION_SELECTOR,
+        # the details are read from the whole page, the college commute table sits outside the section
+        "document": True, "keep": [("class", "transportationDetail")],
+        "extract": extract_nearby_transportation
+    },
+    "scores": {
+        "locate": ("id", "transportationScoreCard"), "root": SCORE_CARD_SELECTOR,
+        "fields": [
+            {"key": ["environment", "transit_score"], "select": TRANSIT_SCORE_SELECTOR},
+            {"key": ["environment", "bike_score"], "select": BIKE_SCORE_SELECTOR},
+            {"key": ["environment", "walk_score"], "select": WALK_SCORE_SELECTOR}
+        ]
+    },
+    "sound": {
+        "locate": ("id", "soundScoreSection"), "root": SOUND_SCORE_SECTION_SELECTOR,
+        "fields": [
+            {"key": ["environment", "sound_score"], "select": SOUND_SCORE_SELECTOR},
+            {"key": ["environment", "traffic_level"], "select": TRAFFIC_LEVEL_SELECTOR},
+            {"key": ["environment", "busi_level"], "select": BUSI_LEVEL_SELECTOR},
+            {"key": ["environment", "airport_level"], "select": AIRPORT_LEVEL_SELECTOR}
+        ]
+    },
+    "pricing": {
+        "locate": ("id", "pricingView"), "root": PRICE_SECTION_SELECTOR,
+        "extract": extract_units_model
+    },
+    "summary": {
+        "locate": ("class", "priceBedRangeInfo"), "root": TOP_MODEL_SELECTOR,
+        "unless": ["pricing"],
+        "extract": extract_whole_model
+    }
+}
+
+SECTIONS_BY_ID = {}
+SECTIONS_BY_CLASS = {}
+KEPT_IDS = set()
+KEPT_CLASSES = set()
+for section_name, section_schema in PAGE_SCHEMA.items():
+    locate_attr, locate_value = section_schema["locate"]
+    section_lookup = SECTIONS_BY_ID if locate_attr == "id" else SECTIONS_BY_CLASS
+    section_lookup.setdefault(locate_value, []).append(section_name)
+    for keep_attr, keep_value in section_schema.get("keep", []):
+        (KEPT_IDS if keep_attr == "id" else KEPT_CLASSES).add(keep_value)
+
+
+def locate_sections(soup):
+    sections = {}
+    for element in soup.descendants:
+        if not isinstance(element, bs4.Tag):
+            continue
+        candidates = SECTIONS_BY_ID.get(element.get("id"), [])
+        for cls in element.get("class") or []:
+            candidates = candidates + SECTIONS_BY_CLASS.get(cls, [])
+        for name in candidates:
+            if name not in sections and PAGE_SCHEMA[name]["root"].match(element):
+                sections[name] = element
+    return sections
+
+
+def set_output_path(output, key, value):
+    for part in key[:-1]:
+        output = output.setdefault(part, {})
+    output[key[-1]] = value
+
+
+def field_text(element, field):
+    text = element.get_text()
+    if field.get("strip", True):
+        text = text.strip()
+    return text
+
+
+def extract_field(section, field, output):
+    selectors = field.get("select", [])
+    if not isinstance(selectors, list):
+        selectors = [selectors]
+    if field.get("all"):
+        values = []
+        for selector in selectors:
+            for element in selector.select(section):
+                values.append(field_text(element, field))
+        if field.get("dedupe"):
+            values = list(set(values))
+        set_output_path(output, field["key"], values)
+        return
+    if "index" in field:
+        matches = selectors[0].select(section, limit=field["index"] + 1)
+        element = matches[field["index"]] if len(matches) > field["index"] else None
+    elif len(selectors) > 0:
+        element = selectors[0].select_one(section)
+    else:
+        element = section
+    if element is None or (field.get("no_attrs") and len(element.attrs) != 0):
+        return
+    set_output_path(output, field["key"], field_text(element, field))
+
+
+def extract_soup(soup, output):
+    sections = locate_sections(soup)
+    for name, section_schema in PAGE_SCHEMA.items():
+        for key, value in section_schema.get("init", {}).items():
+            output[key] = copy.deepcopy(value)
+        section = sections.get(name)
+        if section is None:
+            continue
+        if any(other in sections for other in section_schema.get("unless", [])):
+            continue
+        if any(other not in sections for other in section_schema.get("requires", [])):
+            continue
+        if "extract" in section_schema:
+            section_schema["extract"](soup if section_schema.get("document") else section, output)
+        for field in section_schema.get("fields", []):
+            extract_field(section, field, output)
+
 
 def extract_data(key, input_data):
-    soup = bs4.BeautifulSoup(input_data["html"], "html.parser")
+    soup = make_soup(input_data["html"])
     output = dict(input_data)
     del output["html"]
-    extract_header(soup, output)
-    extract_apartment_desc(soup, output)
-    extract_amenities(soup, output)
-    extract_fees(soup, output)
-    extract_neighbor_desc(soup, output)
-    extract_education(soup, output)
-    extract_nearby_transportation(soup, output)
-    extract_environment(soup, output)
-    extract_model(soup, output)
+    extract_soup(soup, output)
     return key, output
 
 
 def load_json_from(input_dir):
     input_data = {}
 
+    for file, data in iter_json_from(input_dir):
+        input_data[file] = data
+    return input_data
+
+
+def iter_json_from(input_dir):
     for file in os.listdir(input_dir):
         full_path = os.path.join(input_dir, file)
         if ".json" in file and os.path.isfile(full_path):
             with open(full_path, "r") as fp:
-                data = json.load(fp)
-                input_data[file] = data
-    return input_data
+                yield file, json.load(fp)
+
+
+def iter_page_tasks(input_dir):
+    if pagestore.is_page_store(input_dir):
+        for key, entry in pagestore.load_index(input_dir).items():
+            yield key + ".json", input_dir, entry
+    else:
+        for file in os.listdir(input_dir):
+            full_path = os.path.join(input_dir, file)
+            if ".json" in file and os.path.isfile(full_path):
+                yield file, full_path, None
+
+
+def load_page(path, entry):
+    if entry is not None:
+        return pagestore.read_page(path, entry)
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def extractor_version():
+    with open(os.path.abspath(__file__), "rb") as fp:
+        source = fp.read()
+    return hashlib.sha1(source + ("%s,%s" % (PARSER, STRAIN)).encode("utf-8")).hexdigest()
+
+
+def load_manifest(output_dir):
+    manifest = {}
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return manifest
+    with open(path, "r") as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut short by a crash
+                continue
+            manifest[record["key"]] = record
+    return manifest
+
+
+def append_manifest(output_dir, key, page_hash):
+    with open(os.path.join(output_dir, MANIFEST_FILE), "a") as fp:
+        fp.write(json.dumps({"key": key, "hash": page_hash, "version": EXTRACTOR_VERSION}) + "\n")
+
+
+def iter_changed_tasks(input_dir, output_dir, manifest):
+    for key, path, entry in iter_page_tasks(input_dir):
+        previous = manifest.get(key)
+        if previous is not None and not os.path.exists(os.path.join(output_dir, key)):
+            previous = None
+        yield key, path, entry, previous
+
+
+def extract_page(task):
+    key, path, entry, previous = task
+    page = load_page(path, entry)
+    page_hash = hashlib.sha1(page["html"].encode("utf-8")).hexdigest()
+    if previous is not None and previous["hash"] == page_hash and previous["version"] == EXTRACTOR_VERSION:
+        return key, None, page_hash
+    key, output = extract_data(key, page)
+    return key, output, page_hash
+
+
+def extract_page_timed(task):
+    start = time.perf_counter()
+    try:
+        result = extract_page(task)
+        error = None
+    except Exception:
+        # a malformed page is reported and skipped instead of stopping the pool
+        result = (task[0], None, None)
+        error = traceback.format_exc()
+    return os.getpid(), time.perf_counter() - start, result, error
+
+
+def print_worker_throughput(worker_stats, elapsed):
+    total = 0
+    for number, pid in enumerate(sorted(worker_stats)):
+        pages, busy = worker_stats[pid]
+        total = total + pages
+        rate = pages / max(busy, 1e-9)
+        utilization = busy / max(elapsed, 1e-9) * 100
+        print("Worker %d: %d pages, %.1f pages/s busy, %.0f%% utilized" % (number, pages, rate, utilization))
+    rate = total / max(elapsed, 1e-9)
+    print("%d pages in %.1fs with %d workers: %.1f pages/s" % (total, elapsed, len(worker_stats), rate))
+
+
+def init_extract_worker(parser, version):
+    global EXTRACTOR_VERSION
+    set_parser(parser)
+    EXTRACTOR_VERSION = version
+
+
+def set_parser(parser):
+    global PARSER
+    PARSER = parser
+
+
+def set_strain(strain):
+    global STRAIN
+    STRAIN = strain
+
+
+def compare_parsers(input_dir, parsers):
+    tasks = list(iter_page_tasks(input_dir))
+    reference = {}
+    for parser in parsers:
+        set_parser(parser)
+        if STRAIN and parser in UNSTRAINED_PARSERS:
+            print("%s: does not support the strainer, parsing whole pages" % parser)
+        elapsed = 0
+        mismatches = []
+        try:
+            for key, path, entry in tasks:
+                page = load_page(path, entry)
+                start = time.perf_counter()
+                key, output = extract_data(key, page)
+                elapsed = elapsed + time.perf_counter() - start
+                if key not in reference:
+                    reference[key] = output
+                elif reference[key] != output:
+                    mismatches.append(key)
+        except bs4.FeatureNotFound:
+            print("%s: not installed" % parser)
+            continue
+        print("%s: %.1f ms/page, %d/%d pages differ from %s"
+              % (parser, elapsed / max(1, len(tasks)) * 1000, len(mismatches), len(tasks), parsers[0]))
+        for key in mismatches:
+            print("  differs: %s" % key)
+
+
+def benchmark_strainer(input_dir):
+    configured_strain = STRAIN
+    tasks = list(iter_page_tasks(input_dir))
+    totals = {False: [0, 0], True: [0, 0]}
+    mismatches = []
+    for key, path, entry in tasks:
+        page = load_page(path, entry)
+        for strain in (False, True):
+            start = time.perf_counter()
+            make_soup(page["html"], strain)
+            totals[strain][0] = totals[strain][0] + time.perf_counter() - start
+            tracemalloc.start()
+            soup = make_soup(page["html"], strain)
+            totals[strain][1] = totals[strain][1] + tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del soup
+        set_strain(False)
+        full_output = extract_data(key, page)[1]
+        set_strain(True)
+        if full_output != extract_data(key, page)[1]:
+            mismatches.append(key)
+    set_strain(configured_strain)
+    page_count = max(1, len(tasks))
+    for strain, label in ((False, "full page"), (True, "strained")):
+        print("%s: %.1f ms/page to parse, %.0f KB peak/page"
+              % (label, totals[strain][0] / page_count * 1000, totals[strain][1] / page_count / 1024))
+    print("%d/%d pages extract differently when strained" % (len(mismatches), len(tasks)))
+    for key in mismatches:
+        print("  differs: %s" % key)
+
+
+def benchmark_extract(input_dir):
+    tasks = list(iter_page_tasks(input_dir))
+    parse_time = 0
+    extract_time = 0
+    for key, path, entry in tasks:
+        page = load_page(path, entry)
+        start = time.perf_counter()
+        soup = make_soup(page["html"])
+        parse_time = parse_time + time.perf_counter() - start
+        start = time.perf_counter()
+        extract_soup(soup, {})
+        extract_time = extract_time + time.perf_counter() - start
+    page_count = max(1, len(tasks))
+    parse_ms = parse_time / page_count * 1000
+    extract_ms = extract_time / page_count * 1000
+    print("parse: %.2f ms/page, extract: %.2f ms/page" % (parse_ms, extract_ms))
+
+
+def bounded(tasks, slots, stop):
+    for task in tasks:
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield task
 
 
 if __name__ == "__main__":
+    set_parser(cli.pop_option(sys.argv, "--parser", PARSER))
+    if cli.pop_flag(sys.argv, "--compare-parsers"):
+        compare_parsers(sys.argv[1], PARSER_BACKENDS)
+        sys.exit(0)
+    if cli.pop_flag(sys.argv, "--bench"):
+        benchmark_extract(sys.argv[1])
+        sys.exit(0)
+    if cli.pop_flag(sys.argv, "--bench-strainer"):
+        benchmark_strainer(sys.argv[1])
+        sys.exit(0)
+    force = cli.pop_flag(sys.argv, "--force")
+    worker_count = int(cli.pop_option(sys.argv, "--workers", PROCESS_COUNT))
+    chunk_size = int(cli.pop_option(sys.argv, "--chunk-size", CHUNK_SIZE))
     input_dir = sys.argv[1]
     output_dir = sys.argv[2]
-    input_data = load_json_from(input_dir)
-
-    with mp.Pool(PROCESS_COUNT) as pool:
-        results = []
-        for key in input_data:
-            data = input_data[key]
-            results.append(pool.apply_async(extract_data, (key, data)))
-        for res in results:
-            key, output = res.get()
-            print("Finished Extracting: %s" % key)
-            path = os.path.join(output_dir, key)
-            with open(path, "w") as fp:
-                json.dump(output, fp)
+    EXTRACTOR_VERSION = extractor_version()
+    manifest = {}
+    if not force:
+        manifest = load_manifest(output_dir)
+
+    unchanged = 0
+    failed = 0
+    worker_stats = {}
+    start = time.perf_counter()
+    with mp.Pool(worker_count, initializer=init_extract_worker, initargs=(PARSER, EXTRACTOR_VERSION)) as pool:
+        # the pool fills a whole chunk before sending it, so leave room for several per worker
+        slots = threading.BoundedSemaphore(worker_count * chunk_size * CHUNKS_IN_FLIGHT)
+        stop = threading.Event()
+        tasks = bounded(iter_changed_tasks(input_dir, output_dir, manifest), slots, stop)
+        try:
+            for pid, busy, (key, output, page_hash), error in pool.imap_unordered(extract_page_timed, tasks, chunk_size):
+                slots.release()
+                pages, worker_busy = worker_stats.get(pid, (0, 0))
+                worker_stats[pid] = (pages + 1, worker_busy + busy)
+                if error is not None:
+                    failed = failed + 1
+                    print("Failed Extracting: %s\n%s" % (key, error), file=sys.stderr)
+                    continue
+                if output is None:
+                    unchanged = unchanged + 1
+                    continue
+                print("Finished Extracting: %s" % key)
+                path = os.path.join(output_dir, key)
+                with open(path, "w") as fp:
+                    json.dump(output, fp)
+                append_manifest(output_dir, key, page_hash)
+        finally:
+            # wake the pool's task thread if it is waiting for a slot, so the pool can shut down
+            stop.set()
+            try:
+                slots.release()
+            except ValueError:
+                pass
+    print("Skipped %d unchanged pages" % unchanged)
+    print_worker_throughput(worker_stats, time.perf_counter() - start)
+    if failed > 0:
+        print("Failed to extract %d pages" % failed)
+        sys.exit(1)
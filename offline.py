@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+import address
+
+config_file = address.config_file
+ADDRESS_TABLE = config_file.get("OFFLINE", "ADDRESS_TABLE")
+DEST_LOCATION = config_file.get("OFFLINE", "DEST_LOCATION")
+WALK_SPEED_KMH = config_file.getfloat("OFFLINE", "WALK_SPEED_KMH")
+TRANSIT_SPEED_KMH = config_file.getfloat("OFFLINE", "TRANSIT_SPEED_KMH")
+# minutes spent walking to a stop and waiting, added to every transit trip
+TRANSIT_OVERHEAD_MIN = config_file.getfloat("OFFLINE", "TRANSIT_OVERHEAD_MIN")
+# street distance over straight line distance
+DETOUR = config_file.getfloat("OFFLINE", "DETOUR")
+EARTH_RADIUS_M = 6371008.8
+index_cache = {}
+
+
+def read_address_table(path):
+    table = pd.read_csv(path, dtype=str, keep_default_na=False)
+    columns = {col.lower(): col for col in table.columns}
+    if "address" in columns:
+        addresses = table[columns["address"]]
+    else:
+        # openaddresses layout
+        streets = table[columns["number"]] + " " + table[columns["street"]]
+        rows = zip(streets, table[columns["city"]], table[columns["region"]])
+        addresses = [address.ADDR_TEMPLATE % row for row in rows]
+    lats = table[columns["lat"]].astype(float)
+    lngs = table[columns["lng"] if "lng" in columns else columns["lon"]].astype(float)
+    index = {}
+    for addr, lat, lng in zip(addresses, lats, lngs):
+        index[address.normalize_address(addr)] = (lat, lng)
+    return index
+
+
+def address_index():
+    if "index" not in index_cache:
+        index_cache["index"] = read_address_table(ADDRESS_TABLE)
+    return index_cache["index"]
+
+
+def locate(addresses):
+    index = address_index()
+    found = []
+    for addr in addresses:
+        location = index.get(address.normalize_address(addr))
+        if location is None:
+            print("Failed to find lat, lng for: " + addr)
+            continue
+        found.append((addr, location[0], location[1]))
+    return found
+
+
+def destination():
+    if DEST_LOCATION != "":
+        lat, lng = DEST_LOCATION.split(",")
+        return float(lat), float(lng)
+    found = locate(address.DEST[:1])
+    if len(found) == 0:
+        raise ValueError("No location for %s, set DEST_LOCATION" % address.DEST[0])
+    return found[0][1], found[0][2]
+
+
+def haversine(lats, lngs, lat, lng):
+    lats = np.radians(lats)
+    lngs = np.radians(lngs)
+    lat = math.radians(lat)
+    lng = math.radians(lng)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lats) * math.cos(lat) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def fetch_geo(addresses):
+    data_dict = {"address": [], "lat": [], "lng": []}
+    for addr, lat, lng in locate(list(set(addresses))):
+        data_dict["address"].append(addr)
+        data_dict["lat"].append(lat)
+        data_dict["lng"].append(lng)
+    return data_dict
+
+
+def fetch_transit(addresses):
+    found = locate(list(set(addresses)))
+    dest_lat, dest_lng = destination()
+    lats = np.array([lat for addr, lat, lng in found], dtype=float)
+    lngs = np.array([lng for addr, lat, lng in found], dtype=float)
+    distances = haversine(lats, lngs, dest_lat, dest_lng) * DETOUR
+    walk_times = distances / (WALK_SPEED_KMH * 1000 / 60)
+    # a trip short enough to walk is walked, as the transit directions would do
+    transit_times = np.minimum(walk_times, TRANSIT_OVERHEAD_MIN + distances / (TRANSIT_SPEED_KMH * 1000 / 60))
+    return {
+        "address": [addr for addr, lat, lng in found],
+        "distance": np.rint(distances).astype(int).tolist(),
+        "walk.time": walk_times.tolist(),
+        "transit.time": transit_times.tolist()
+    }
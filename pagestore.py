@@ -0,0 +1,72 @@
+import gzip
+import hashlib
+import json
+import os
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+# a writer moves on to a new segment file once its current one reaches this size
+SEGMENT_SIZE = 256 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+
+def url_key(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def is_page_store(directory):
+    for file in os.listdir(directory):
+        if file.endswith(INDEX_SUFFIX):
+            return True
+    return False
+
+
+def writer_segment(directory, prefix):
+    number = 0
+    while True:
+        segment = "%s-%04d" % (prefix, number)
+        path = os.path.join(directory, segment + SEGMENT_SUFFIX)
+        if not os.path.exists(path) or os.path.getsize(path) < SEGMENT_SIZE:
+            return segment
+        number = number + 1
+
+
+def append_page(directory, segment, record):
+    data = gzip.compress(json.dumps(record).encode("utf-8"), COMPRESS_LEVEL)
+    with open(os.path.join(directory, segment + SEGMENT_SUFFIX), "ab") as fp:
+        offset = fp.tell()
+        fp.write(data)
+    # the index line is written after the data so it never points past the end of a segment
+    entry = {"key": url_key(record["url"]), "url": record["url"], "segment": segment,
+             "offset": offset, "length": len(data)}
+    with open(os.path.join(directory, segment + INDEX_SUFFIX), "a") as fp:
+        fp.write(json.dumps(entry) + "\n")
+    return entry
+
+
+def load_index(directory):
+    index = {}
+    for file in sorted(os.listdir(directory)):
+        if not file.endswith(INDEX_SUFFIX):
+            continue
+        with open(os.path.join(directory, file), "r") as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be cut short by a crash
+                    continue
+                index[entry["key"]] = entry
+    return index
+
+
+def read_page(directory, entry):
+    with open(os.path.join(directory, entry["segment"] + SEGMENT_SUFFIX), "rb") as fp:
+        fp.seek(entry["offset"])
+        data = fp.read(entry["length"])
+    return json.loads(gzip.decompress(data))
+
+
+def iter_pages(directory):
+    for key, entry in load_index(directory).items():
+        yield key, read_page(directory, entry)
@@ -0,0 +1,171 @@
+import json
+import math
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import address
+import cli
+
+EARTH_RADIUS_M = 6371008.8
+FILTER_FIELDS = ["rent", "beds", "sqft"]
+# candidates fetched per wanted neighbor when filters drop some of them
+KNN_OVERSAMPLE = 4
+
+
+def as_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return float("nan")
+    return float(value)
+
+
+def load_listings(compile_path="compile.json", geo_path="geo.csv"):
+    with open(compile_path, "r") as fp:
+        apartments = json.load(fp)
+    geo = pd.read_csv(geo_path)
+    locations = dict(zip(geo["address"], zip(geo["lat"], geo["lng"])))
+    listings = {"name": [], "model": [], "address": [], "lat": [], "lng": [], "rent": [], "beds": [], "sqft": []}
+    for apartment in apartments:
+        addr = address.ADDR_TEMPLATE % (apartment["address"], apartment["city"], apartment["state"])
+        if addr not in locations or "models" not in apartment:
+            continue
+        lat, lng = locations[addr]
+        for model in apartment["models"]:
+            listings["name"].append(apartment["name"])
+            listings["model"].append(model["name"])
+            listings["address"].append(addr)
+            listings["lat"].append(lat)
+            listings["lng"].append(lng)
+            for field in FILTER_FIELDS:
+                listings[field].append(as_number(model.get(field)))
+    for field in ["lat", "lng"] + FILTER_FIELDS:
+        listings[field] = np.array(listings[field], dtype=float)
+    return listings
+
+
+def unit_vectors(lats, lngs):
+    lats = np.radians(lats)
+    lngs = np.radians(lngs)
+    return np.column_stack([np.cos(lats) * np.cos(lngs), np.cos(lats) * np.sin(lngs), np.sin(lats)])
+
+
+def build_index(listings):
+    # points on the unit sphere, so the tree's euclidean distance is the chord of the great circle
+    listings["tree"] = cKDTree(unit_vectors(listings["lat"], listings["lng"]))
+    return listings
+
+
+def chord_length(meters):
+    return 2 * math.sin(min(meters / EARTH_RADIUS_M, math.pi) / 2)
+
+
+def chord_meters(chords):
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(chords, 2) / 2)
+
+
+def filter_mask(index, filters, rows=None):
+    if rows is None:
+        rows = slice(None)
+    mask = np.ones(len(index["lat"][rows]), dtype=bool)
+    for field in filters:
+        low, high = filters[field]
+        values = index[field][rows]
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+    return mask
+
+
+def radius_query(index, lat, lng, meters, filters=None):
+    point = unit_vectors([lat], [lng])[0]
+    found = np.array(index["tree"].query_ball_point(point, chord_length(meters)), dtype=int)
+    if filters:
+        found = found[filter_mask(index, filters, found)]
+    distances = chord_meters(np.linalg.norm(index["tree"].data[found] - point, axis=1))
+    order = np.argsort(distances, kind="stable")
+    return found[order], distances[order]
+
+
+def nearest_query(index, lat, lng, k, filters=None):
+    point = unit_vectors([lat], [lng])[0]
+    total = len(index["lat"])
+    mask = None
+    if filters:
+        mask = filter_mask(index, filters)
+        k = min(k, int(mask.sum()))
+    k = min(k, total)
+    if k == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+    fetch = k if mask is None else min(total, k * KNN_OVERSAMPLE)
+    while True:
+        chords, found = index["tree"].query(point, fetch)
+        chords = np.atleast_1d(chords)
+        found = np.atleast_1d(found)
+        if mask is not None:
+            keep = mask[found]
+            chords = chords[keep]
+            found = found[keep]
+        if len(found) >= k or fetch == total:
+            return found[:k], chord_meters(chords[:k])
+        fetch = min(total, fetch * 2)
+
+
+def bbox_query(index, south, west, north, east, filters=None):
+    center = unit_vectors([(south + north) / 2], [(west + east) / 2])[0]
+    corners = unit_vectors([south, south, north, north], [west, east, west, east])
+    # the corners are the points of the box farthest from its center, so this circle covers the box
+    radius = np.linalg.norm(corners - center, axis=1).max() * (1 + 1e-9)
+    found = np.sort(np.array(index["tree"].query_ball_point(center, radius), dtype=int))
+    lats = index["lat"][found]
+    lngs = index["lng"][found]
+    mask = (lats >= south) & (lats <= north) & (lngs >= west) & (lngs <= east)
+    if filters:
+        mask &= filter_mask(index, filters, found)
+    return found[mask]
+
+
+def select(index, found, distances=None):
+    columns = {}
+    for field in ["name", "model", "address"]:
+        columns[field] = [index[field][i] for i in found]
+    for field in ["lat", "lng"] + FILTER_FIELDS:
+        columns[field] = index[field][found]
+    if distances is not None:
+        columns["distance"] = distances
+    return pd.DataFrame(columns)
+
+
+def pop_filters(args):
+    filters = {}
+    for field in FILTER_FIELDS:
+        low = cli.pop_option(args, "--min-" + field)
+        high = cli.pop_option(args, "--max-" + field)
+        if low is not None or high is not None:
+            filters[field] = (None if low is None else float(low), None if high is None else float(high))
+    return filters
+
+
+if __name__ == "__main__":
+    compile_path = cli.pop_option(sys.argv, "--compile", "compile.json")
+    geo_path = cli.pop_option(sys.argv, "--geo", "geo.csv")
+    filters = pop_filters(sys.argv)
+    index = build_index(load_listings(compile_path, geo_path))
+    kind = sys.argv[1]
+    values = [float(value) for value in sys.argv[2:]]
+    start = time.perf_counter()
+    if kind == "radius":
+        found, distances = radius_query(index, values[0], values[1], values[2], filters)
+    elif kind == "knn":
+        found, distances = nearest_query(index, values[0], values[1], int(values[2]), filters)
+    elif kind == "bbox":
+        found = bbox_query(index, values[0], values[1], values[2], values[3], filters)
+        distances = None
+    else:
+        raise ValueError("Unknown query: " + kind)
+    elapsed = time.perf_counter() - start
+    print(select(index, found, distances).to_string(index=False))
+    print("%d models in %.3f ms" % (len(found), elapsed * 1000))
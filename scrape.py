@@ -1,8 +1,13 @@
 import json
+import math
+import multiprocessing as mp
+import os
 import random
 import re
+import sys
 import time
 from configparser import ConfigParser
+from multiprocessing.util import Finalize
 
 from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, WebDriverException
 from selenium.webdriver import ActionChains
@@ -13,6 +18,8 @@ from selenium.webdriver.support.wait import WebDriverWait
 from seleniumwire import webdriver
 from selenium.webdriver.chrome.service import Service
 
+import cli
+
 config_file = ConfigParser()
 config_file.read("config.ini")
 chrome_options = Options()
@@ -39,18 +46,93 @@ PAGE_RANGE_REGEX_GROUP = config_file.get("MATCHING", "PAGE_RANGE_REGEX_GROUP")
 # control parameters
 INCREMENT = int(config_file.get("MATCHING", "PRICE_INCREMENT"))
 MAX_PAGE_COUNT = int(config_file.get("MATCHING", "MAX_PAGE_COUNT"))
+ADAPTIVE_PARTITION = config_file.getboolean("MATCHING", "ADAPTIVE_PARTITION")
+PARTITION_FILL = 0.8
+PARTITION_MAX_GROWTH = 4
+REPLAY_PAGE_SIZE = 40
 NEXT_SLEEP = int(config_file.get("BASIC", "SLEEP"))
+SCRAPE_WORKERS = int(config_file.get("BASIC", "SCRAPE_WORKERS"))
+CHECKPOINT_PATH = config_file.get("BASIC", "CHECKPOINT")
+BANDS_PER_WORKER = 4
 
 # targets for the scraper
 URL = config_file.get("TARGET", "URL_TEMPLATE")
 START_PRICE = int(config_file.get("TARGET", "START_PRICE"))
 MAX_PRICE = int(config_file.get("TARGET", "MAX_PRICE"))
 
+# requests dropped by the browser proxy
+BLOCK_REQUESTS = config_file.getboolean("BLOCKING", "ENABLED")
+BLOCK_TYPES = {t.strip() for t in config_file.get("BLOCKING", "BLOCK_TYPES").split(",") if len(t.strip()) != 0}
+BLOCK_HOSTS = [h.strip() for h in config_file.get("BLOCKING", "BLOCK_HOSTS").split(",") if len(h.strip()) != 0]
+ALLOW_HOSTS = [h.strip() for h in config_file.get("BLOCKING", "ALLOW_HOSTS").split(",") if len(h.strip()) != 0]
+RESOURCE_EXTENSIONS = {
+    "image": (".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".svg", ".ico", ".bmp"),
+    "font": (".woff", ".woff2", ".ttf", ".otf", ".eot"),
+    "media": (".mp4", ".webm", ".m3u8", ".mp3", ".ogg"),
+    "stylesheet": (".css",),
+    "script": (".js",)
+}
+RESOURCE_ACCEPT_PREFIXES = {"image/": "image", "font/": "font", "video/": "media", "audio/": "media",
+                            "text/css": "stylesheet"}
+
 
 def get_next_sleep():
     return random.randint(1, NEXT_SLEEP + 1)
 
 
+def matches_host(host, patterns):
+    for pattern in patterns:
+        if host == pattern or host.endswith("." + pattern):
+            return True
+    return False
+
+
+def request_resource_type(request):
+    path = request.path.split("?")[0].lower()
+    for resource_type, extensions in RESOURCE_EXTENSIONS.items():
+        if path.endswith(extensions):
+            return resource_type
+    accept = request.headers.get("Accept", "") or ""
+    for prefix, resource_type in RESOURCE_ACCEPT_PREFIXES.items():
+        if accept.startswith(prefix):
+            return resource_type
+    return "other"
+
+
+def is_blocked_request(request):
+    host = request.host.lower()
+    if matches_host(host, ALLOW_HOSTS):
+        return False
+    return matches_host(host, BLOCK_HOSTS) or request_resource_type(request) in BLOCK_TYPES
+
+
+def install_request_blocker(driver):
+    stats = {"blocked": 0}
+
+    def block_interceptor(request):
+        if is_blocked_request(request):
+            stats["blocked"] = stats["blocked"] + 1
+            request.abort()
+
+    if BLOCK_REQUESTS:
+        driver.request_interceptor = block_interceptor
+    return stats
+
+
+def collect_request_stats(driver, stats):
+    requests = 0
+    received = 0
+    for request in driver.requests:
+        requests = requests + 1
+        if request.response is not None and request.response.body is not None:
+            received = received + len(request.response.body)
+    blocked = stats["blocked"]
+    stats["blocked"] = 0
+    # seleniumwire keeps every captured request until it is cleared
+    del driver.requests
+    return requests, blocked, received
+
+
 def find_scroll_and_wait(driver, by, value):
     element = driver.find_element(by, value)
     return scroll_and_wait(driver, element)
@@ -59,19 +141,19 @@ def find_scroll_and_wait(driver, by, value):
 def scroll_and_wait(driver, element):
     act = ActionChains(driver).move_to_element(element)
     act.perform()
-    wait = WebDriverWait(chrome_driver, int(config_file.get("BASIC", "WAIT")))
+    wait = WebDriverWait(driver, int(config_file.get("BASIC", "WAIT")))
     element = wait.until(EC.visibility_of(element))
     return element
 
 
 def wait_scroll_and_wait(driver, by, value):
-    wait = WebDriverWait(chrome_driver, int(config_file.get("BASIC", "WAIT")))
+    wait = WebDriverWait(driver, int(config_file.get("BASIC", "WAIT")))
     element = wait.until(EC.presence_of_element_located((by, value)))
     return scroll_and_wait(driver, element)
 
 
-def wait_for_search(xpath):
-    wait = WebDriverWait(chrome_driver, int(config_file.get("BASIC", "WAIT")))
+def wait_for_search(driver, xpath):
+    wait = WebDriverWait(driver, int(config_file.get("BASIC", "WAIT")))
     wait.until(EC.presence_of_element_located((By.XPATH, xpath)))
     return
 
@@ -90,7 +172,7 @@ def find_num_results(driver, no_res_path, res_count_path, page_regex, page_regex
 
 
 def go_to_next_page(driver, current, next_xpath):
-    wait = WebDriverWait(chrome_driver, int(config_file.get("BASIC", "WAIT")))
+    wait = WebDriverWait(driver, int(config_file.get("BASIC", "WAIT")))
     wait.until(EC.presence_of_element_located((By.XPATH, PAGE_NAV_XPATH)))
     while True:
         try:
@@ -107,7 +189,7 @@ def go_to_next_page(driver, current, next_xpath):
 
 def scan_current_page(driver, link_path):
     result = []
-    wait = WebDriverWait(chrome_driver, int(config_file.get("BASIC", "WAIT")))
+    wait = WebDriverWait(driver, int(config_file.get("BASIC", "WAIT")))
     while len(result) == 0:
         try:
             wait.until(EC.element_to_be_clickable((By.XPATH, link_path)))
@@ -121,6 +203,7 @@ def scan_current_page(driver, link_path):
 
 def set_price_range(driver, current, increment):
     next_url = URL % (current, current + increment)
+    del driver.requests
     while True:
         try:
             driver.get(next_url)
@@ -129,14 +212,14 @@ def set_price_range(driver, current, increment):
                 break
         except WebDriverException:
             pass
-    wait_for_search(SEARCH_WAIT_XPATH)
+    wait_for_search(driver, SEARCH_WAIT_XPATH)
     page_count = find_num_results(driver, NO_RES_XPATH, RES_COUNT_XPATH, PAGE_RANGE_REGEX, PAGE_RANGE_REGEX_GROUP)
     return page_count
 
 
 def initialize_scraping(driver, base_price):
     current = 0
-    wait_for_search(SEARCH_WAIT_XPATH)
+    wait_for_search(driver, SEARCH_WAIT_XPATH)
     page_count = find_num_results(driver, NO_RES_XPATH, RES_COUNT_XPATH, PAGE_RANGE_REGEX, PAGE_RANGE_REGEX_GROUP)
     print(page_count)
 
@@ -159,53 +242,276 @@ def scan_until_success(driver, initial_results, current_page):
         if next_retry > 10:
             raise TimeoutError()
         time.sleep(get_next_sleep())
-        wait_for_search(SEARCH_WAIT_XPATH)
+        wait_for_search(driver, SEARCH_WAIT_XPATH)
         current_result = scan_current_page(driver, LINK_XPATH)
         next_retry = next_retry + 1
     return current_result
 
 
-def scrape_apartments(driver, start_price, init_pages, increment):
+def scan_price_range(driver, page_count, on_page=None):
     results = []
+    first_result = scan_current_page(driver, LINK_XPATH)
+    print("Added: %s" % first_result)
+    results.extend(scan_current_page(driver, LINK_XPATH))
+    if on_page is not None:
+        on_page(0, first_result)
+    prev_results = first_result
+    for i in range(1, page_count):
+        go_to_next_page(driver, i, NEXT_PAGE_XPATH)
+        current_result = scan_until_success(driver, prev_results, i)
+        prev_results = current_result
+        results.extend(current_result)
+        print("Added: %s" % current_result)
+        if on_page is not None:
+            on_page(i, current_result)
+    return results
+
+
+def walk_price_range(count_pages, scan_band, start_price, init_pages, increment, max_price):
+    loads = 0
     current = start_price
     page_count = init_pages
 
-    while current <= MAX_PRICE:
-        try:
-            while page_count > MAX_PAGE_COUNT:
-                increment = max(1, increment / 2)
-                page_count = set_price_range(driver, current, increment)
-            print("Pages:" + str(page_count))
-            if page_count > 0:
-                first_result = scan_current_page(driver, LINK_XPATH)
-                print("Added: %s" % first_result)
-                results.extend(scan_current_page(driver, LINK_XPATH))
-                prev_results = first_result
-                for i in range(1, page_count):
-                    go_to_next_page(driver, i, NEXT_PAGE_XPATH)
-                    current_result = scan_until_success(driver, prev_results, i)
-                    prev_results = current_result
-                    results.extend(current_result)
-                    print("Added: %s" % current_result)
-        except TimeoutError:
-            break
+    while current <= max_price:
+        high = min(max_price, current + increment)
+        while page_count > MAX_PAGE_COUNT and increment > 1:
+            increment = max(1, increment / 2)
+            high = min(max_price, current + increment)
+            page_count = count_pages(current, high)
+            loads = loads + 1
+        print("Pages:" + str(page_count))
+        if page_count > 0:
+            scan_band(current, high, page_count)
 
         if page_count < 20:
             increment = increment + 5
         current += increment
-        page_count = set_price_range(driver, current, INCREMENT)
+        if current <= max_price:
+            page_count = count_pages(current, min(max_price, current + INCREMENT))
+            loads = loads + 1
+    return loads
+
+
+def next_band_width(width, page_count):
+    if page_count == 0:
+        return (width + 1) * PARTITION_MAX_GROWTH
+    # assume listings are spread evenly over the band and aim just under the page limit
+    estimate = int((width + 1) * MAX_PAGE_COUNT * PARTITION_FILL / page_count) - 1
+    if page_count > MAX_PAGE_COUNT:
+        return max(0, min(estimate, width // 2))
+    return max(0, min(estimate, (width + 1) * PARTITION_MAX_GROWTH))
+
+
+def partition_price_range(count_pages, scan_band, start_price, init_pages, increment, max_price):
+    loads = 0
+    low = start_price
+    width = increment
+    page_count = init_pages
+
+    while low <= max_price:
+        high = min(max_price, low + width)
+        if page_count is None:
+            page_count = count_pages(low, high)
+            loads = loads + 1
+        width = next_band_width(high - low, page_count)
+        if page_count > MAX_PAGE_COUNT and high > low:
+            page_count = None
+            continue
+        print("Pages:" + str(page_count))
+        if page_count > 0:
+            scan_band(low, high, page_count)
+        low = high + 1
+        page_count = None
+    return loads
+
+
+def load_checkpoint(path):
+    checkpoint = {"links": [], "resume": {}, "done": set(), "plan": None}
+    if not os.path.exists(path):
+        return checkpoint
+    with open(path, "r") as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut short by a crash
+                continue
+            if "plan" in record:
+                checkpoint["plan"] = [tuple(band) for band in record["plan"]]
+                continue
+            band = tuple(record["band"])
+            if "links" in record:
+                checkpoint["links"].extend(record["links"])
+            elif "range" in record:
+                checkpoint["resume"][band] = max(checkpoint["resume"].get(band, 0), record["range"][1] + 1)
+            elif record.get("done"):
+                checkpoint["done"].add(band)
+    return checkpoint
+
+
+def append_checkpoint(path, record):
+    with open(path, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
+        fp.flush()
+
+
+def scrape_apartments(driver, start_price, init_pages, increment, max_price=MAX_PRICE, band=None):
+    results = []
+
+    def count_pages(low, high):
+        return set_price_range(driver, low, high - low)
+
+    def scan_band(low, high, page_count):
+        def save_page(page, links):
+            append_checkpoint(CHECKPOINT_PATH, {"band": band, "range": [low, high], "page": page, "links": links})
+
+        results.extend(scan_price_range(driver, page_count, save_page if band is not None else None))
+        if band is not None:
+            append_checkpoint(CHECKPOINT_PATH, {"band": band, "range": [low, high], "pages": page_count})
         print("Scanned Apartments: " + str(len(set(results))))
+
+    try:
+        if ADAPTIVE_PARTITION:
+            loads = partition_price_range(count_pages, scan_band, start_price, init_pages, increment, max_price)
+        else:
+            loads = walk_price_range(count_pages, scan_band, start_price, init_pages, increment, max_price)
+    except TimeoutError:
+        print("Timed out scanning from %d, rerun to resume from the checkpoint" % start_price)
+        return results
+    print("Price range loads: %d" % loads)
+    if band is not None:
+        append_checkpoint(CHECKPOINT_PATH, {"band": band, "done": True})
     return results
 
 
-if __name__ == "__main__":
-    chrome_driver = webdriver.Chrome(service=Service(config_file.get("BASIC", "DRIVER")), options=chrome_options)
-    start = START_PRICE
-    chrome_driver.get(URL % (START_PRICE, START_PRICE))
-    chrome_driver.maximize_window()
-    start_price, init_pages = initialize_scraping(chrome_driver, start)
+def load_replay_counter(compile_path):
+    with open(compile_path, "r") as fp:
+        apartments = json.load(fp)
+    rent_ranges = []
+    for apartment in apartments:
+        rents = [model["rent"] for model in apartment.get("models", []) if not math.isnan(model["rent"])]
+        if len(rents) > 0:
+            rent_ranges.append((min(rents), max(rents)))
+
+    def count_pages(low, high):
+        listings = 0
+        for min_rent, max_rent in rent_ranges:
+            if min_rent <= high and max_rent >= low:
+                listings = listings + 1
+        return math.ceil(listings / REPLAY_PAGE_SIZE)
+
+    return count_pages
+
+
+def replay_partition(compile_path):
+    count_pages = load_replay_counter(compile_path)
+
+    def skip_band(low, high, page_count):
+        pass
+
+    init_pages = count_pages(START_PRICE, START_PRICE + INCREMENT)
+    walk_loads = walk_price_range(count_pages, skip_band, START_PRICE, init_pages, INCREMENT, MAX_PRICE)
+    adaptive_loads = partition_price_range(count_pages, skip_band, START_PRICE, init_pages, INCREMENT, MAX_PRICE)
+    print("Walk: %d price range loads" % (walk_loads + 1))
+    print("Adaptive: %d price range loads" % (adaptive_loads + 1))
+    for low, high in plan_price_bands(count_pages, START_PRICE, MAX_PRICE, max(1, SCRAPE_WORKERS) * BANDS_PER_WORKER):
+        print("Band %d-%d: %d pages" % (low, high, count_pages(low, high)))
+
+
+def create_driver():
+    driver = webdriver.Chrome(service=Service(config_file.get("BASIC", "DRIVER")), options=chrome_options)
+    driver.maximize_window()
+    install_request_blocker(driver)
+    return driver
+
+
+def plan_price_bands(count_pages, start_price, max_price, band_count):
+    segments = []
+
+    def add_segment(low, high, page_count):
+        segments.append((high, page_count))
+
+    partition_price_range(count_pages, add_segment, start_price, None, INCREMENT, max_price)
+    # cut the range where the running page count reaches an even share, not at even dollar widths
+    target = max(1, sum(page_count for high, page_count in segments) / band_count)
+    bands = []
+    low = start_price
+    pages = 0
+    for high, page_count in segments:
+        pages = pages + page_count
+        if pages >= target and high < max_price:
+            bands.append((low, high))
+            low = high + 1
+            pages = 0
+    if low <= max_price:
+        bands.append((low, max_price))
+    return bands
+
+
+def init_band_worker(band_checkpoint):
+    global chrome_driver, checkpoint
+    checkpoint = band_checkpoint
+    chrome_driver = create_driver()
+    # quit the browser when the pool shuts the worker down
+    Finalize(chrome_driver, chrome_driver.quit, exitpriority=10)
+
+
+def scrape_band(band):
+    low, high = band
+    start_price = checkpoint["resume"].get(band, low)
+    page_count = set_price_range(chrome_driver, start_price, min(high, start_price + INCREMENT) - start_price)
+    return band, scrape_apartments(chrome_driver, start_price, page_count, INCREMENT, high, band)
+
+
+def scrape_parallel(plan, worker_count, band_checkpoint):
+    bands = []
+    for band in plan:
+        if band not in band_checkpoint["done"]:
+            bands.append(band)
+    results = []
+    pool = mp.Pool(worker_count, initializer=init_band_worker, initargs=(band_checkpoint,))
+    try:
+        for band, band_results in pool.imap_unordered(scrape_band, bands):
+            results.extend(band_results)
+            print("Finished band %d-%d: %d links" % (band[0], band[1], len(band_results)))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
 
-    results = scrape_apartments(chrome_driver, start_price, init_pages, INCREMENT)
+if __name__ == "__main__":
+    replay_path = cli.pop_option(sys.argv, "--replay")
+    if replay_path is not None:
+        replay_partition(replay_path)
+        sys.exit(0)
+
+    checkpoint = load_checkpoint(CHECKPOINT_PATH)
+    results = list(checkpoint["links"])
+    plan = checkpoint["plan"]
+    if plan is None:
+        if SCRAPE_WORKERS > 1:
+            planning_driver = create_driver()
+            try:
+                plan = plan_price_bands(lambda low, high: set_price_range(planning_driver, low, high - low),
+                                        START_PRICE, MAX_PRICE, SCRAPE_WORKERS * BANDS_PER_WORKER)
+            finally:
+                planning_driver.quit()
+        else:
+            plan = [(START_PRICE, MAX_PRICE)]
+        # records are keyed by these bands, so keep using them even if the worker count changes
+        append_checkpoint(CHECKPOINT_PATH, {"plan": plan})
+
+    if SCRAPE_WORKERS > 1:
+        results.extend(scrape_parallel(plan, SCRAPE_WORKERS, checkpoint))
+    elif any(band not in checkpoint["done"] for band in plan):
+        chrome_driver = create_driver()
+        for band in plan:
+            if band not in checkpoint["done"]:
+                results.extend(scrape_band(band)[1])
 
     results = list(set(results))
     with open("urls.json", "w") as file: